@@ -0,0 +1,973 @@
+#!/usr/bin/env python
+
+# Benchmarks installer.py end to end without real container runtimes. Stand-in
+# docker, singularity and curl executables are put on PATH, and a stand-in
+# dockerd serves the Docker Engine API for the docker-engine scenario. They
+# have configurable latency, pull time and payload sizes, and serve a generated
+# release tarball and SIF/SIMG image. Each scenario runs installer.py --force
+# several times. Options the benchmarked installer does not have yet are left
+# out, and scenarios that need them are skipped. Wall time, bytes and syscalls written, and peak temporary
+# space are reported per run and per install phase (from the install
+# timeline). Results are written as JSON tagged with the git commit of the
+# installer, and --compare shows the change against an earlier result file.
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+SQUASHFS_METADATA_SIZE = 8192
+SQUASHFS_UNCOMPRESSED = 0x1000000
+SIF_DESCRIPTOR_FORMAT = "<iBIIIqqqqqqq128s384s"
+TIMELINE_LINE = re.compile(r"^Install timeline written to (\S+)", re.M)
+IO_COUNTERS = ["rchar", "wchar", "syscr", "syscw", "read_bytes", "write_bytes"]
+
+# Runs installer.py in this interpreter and writes /proc/self/io when it exits.
+# Linux adds the counters of every reaped child to /proc/<pid>/io of its parent,
+# so the stand-in tools and helpers such as tar would count as installer I/O.
+# os.waitpid is wrapped before subprocess binds it: each child's counters are
+# read while it is a zombie, right before it is reaped, and written out with
+# the time of the reap so the bench can subtract them. Without os.waitid
+# (Python 2) the children stay included.
+IO_BOOTSTRAP = """
+import atexit, json, os, runpy, sys, time
+io_path = sys.argv[1]
+reaped_children = []
+real_waitpid = os.waitpid
+
+def read_io(pid):
+  try:
+    with open("/proc/%s/io" % pid) as proc_io:
+      return proc_io.read()
+  except (IOError, OSError):
+    return None
+
+def waitpid(pid, options):
+  if pid <= 0 or not hasattr(os, "waitid"):
+    return real_waitpid(pid, options)
+  try:
+    exited = os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT | (options & os.WNOHANG))
+  except OSError:
+    return real_waitpid(pid, options)
+  if exited == None:
+    return real_waitpid(pid, options)
+  counters = read_io(pid)
+  result = real_waitpid(pid, options)
+  if result[0] == pid and counters != None:
+    reaped_children.append({"time": time.time(), "io": counters})
+  return result
+os.waitpid = waitpid
+
+def write_io():
+  counters = read_io("self")
+  if counters == None:
+    return
+  try:
+    with open(io_path, "w") as io_file:
+      json.dump({"io": counters, "children": reaped_children}, io_file)
+  except (IOError, OSError):
+    pass
+atexit.register(write_io)
+sys.argv = sys.argv[2:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+# The stand-in docker, dockerd, singularity and curl. All are links to this one
+# script, which reads its settings from $PB_BENCH_STATE/config.json and keeps
+# the fake docker image store in $PB_BENCH_STATE/images.json. dockerd serves
+# the Docker Engine API on the unix socket given as its argument.
+FAKE_RUNTIME = r'''
+import fcntl, hashlib, json, os, shutil, sys, tarfile, time
+
+state_dir = os.environ["PB_BENCH_STATE"]
+with open(os.path.join(state_dir, "config.json")) as config_file:
+  config = json.load(config_file)
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+stdout = getattr(sys.stdout, "buffer", sys.stdout)
+
+with open(os.path.join(state_dir, "calls.txt"), "a") as calls_file:
+  calls_file.write(tool + " " + " ".join(args) + "\n")
+time.sleep(config["latency"])
+
+def update_images(update):
+  with open(os.path.join(state_dir, "images.lock"), "a") as lock_file:
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    images_path = os.path.join(state_dir, "images.json")
+    images = {}
+    if os.path.exists(images_path):
+      with open(images_path) as images_file:
+        images = json.load(images_file)
+    result = update(images)
+    with open(images_path + ".tmp", "w") as images_file:
+      json.dump(images, images_file)
+    os.rename(images_path + ".tmp", images_path)
+    return result
+
+# Images are keyed by Id, like in dockerd. The Id only depends on the tag, so
+# the registry image and parabricks/release of one release are the same image.
+def get_image_id(image_ref):
+  return "sha256:" + hashlib.sha256(image_ref.rsplit(":", 1)[1].encode()).hexdigest()
+
+def find_image(images, image_ref):
+  for image in images.values():
+    if image_ref == image["Id"] or image_ref in image["RepoTags"]:
+      return image
+  return None
+
+def add_image(images, image_ref, repo_digest):
+  image = images.setdefault(get_image_id(image_ref), {"Id": get_image_id(image_ref), "Size": config["image_bytes"], "RepoTags": [], "RepoDigests": []})
+  add_tag(images, image, image_ref)
+  if repo_digest != None and repo_digest not in image["RepoDigests"]:
+    image["RepoDigests"].append(repo_digest)
+
+def add_tag(images, image, image_ref):
+  for other_image in images.values():
+    if image_ref in other_image["RepoTags"]:
+      other_image["RepoTags"].remove(image_ref)
+  image["RepoTags"].append(image_ref)
+
+# As in dockerd, removing the last tag of a repository also drops the digest
+# references of that repository, and removing the last tag deletes the image
+def remove_tag(images, image, image_ref):
+  image["RepoTags"].remove(image_ref)
+  repository = image_ref.rsplit(":", 1)[0]
+  if not any(repo_tag.rsplit(":", 1)[0] == repository for repo_tag in image["RepoTags"]):
+    image["RepoDigests"] = [repo_digest for repo_digest in image["RepoDigests"] if not repo_digest.startswith(repository + "@")]
+  if not image["RepoTags"]:
+    del images[image["Id"]]
+
+def show_pull_progress(line_format):
+  layers = ["%012x" % (0xa1b2c3d4e5f0 + i) for i in range(config["layers"])]
+  layer_mb = config["image_bytes"] / 1048576.0 / len(layers)
+  steps = 20
+  for step in range(1, steps + 1):
+    for layer in layers:
+      print(line_format % (layer, layer_mb * step / steps, layer_mb))
+    sys.stdout.flush()
+    time.sleep(config["pull_seconds"] / steps)
+
+def write_payload(path, header, size):
+  with open(path, "wb") as payload_file:
+    payload_file.write(header)
+    chunk = b"\0" * 1048576
+    remaining = size
+    while remaining > 0:
+      payload_file.write(chunk[:min(remaining, len(chunk))])
+      remaining -= len(chunk)
+
+def docker():
+  command = args[0] if args else ""
+  if command == "pull":
+    show_pull_progress("%s: Downloading [==>    ]  %.2fMB/%.2fMB")
+    repo_digest = args[1].rsplit(":", 1)[0] + "@sha256:" + hashlib.sha256(("manifest " + args[1]).encode()).hexdigest()
+    update_images(lambda images: add_image(images, args[1], repo_digest))
+    print("Status: Downloaded newer image for " + args[1])
+  elif command == "inspect":
+    image_ref = args[-1]
+    found = update_images(lambda images: find_image(images, image_ref))
+    if found == None:
+      sys.stderr.write("Error: No such image: " + image_ref + "\n")
+      return 1
+    print(json.dumps([found]))
+  elif command == "tag":
+    def tag(images):
+      image = find_image(images, args[1])
+      if image == None:
+        return 1
+      add_tag(images, image, args[2])
+      return 0
+    return update_images(tag)
+  elif command == "rmi":
+    def remove(images):
+      missing = []
+      for image_ref in args[1:]:
+        image = find_image(images, image_ref)
+        if image == None:
+          missing.append(image_ref)
+        elif image_ref == image["Id"]:
+          del images[image["Id"]]
+        else:
+          remove_tag(images, image, image_ref)
+      return missing
+    missing = update_images(remove)
+    for image_ref in missing:
+      sys.stderr.write("Error: No such image: " + image_ref + "\n")
+    return 1 if missing else 0
+  elif command == "images":
+    # Older installers parse the table docker images prints without --format
+    if "--format" not in args:
+      print("%-40s %-10s %-14s %-16s %s" % ("REPOSITORY", "TAG", "IMAGE ID", "CREATED", "SIZE"))
+    for image in update_images(lambda images: list(images.values())):
+      for image_ref in sorted(image["RepoTags"]):
+        repository, tag = image_ref.rsplit(":", 1)
+        if "--format" not in args:
+          print("%-40s %-10s %-14s %-16s %.3fGB" % (repository, tag, image["Id"][7:19], "2 days ago", image["Size"] / 1e9))
+        elif repository == "parabricks/release":
+          print(json.dumps({"Repository": repository, "Tag": tag, "ID": image["Id"][7:19], "Size": "%.3fGB" % (image["Size"] / 1e9)}))
+  elif command == "create":
+    print("fakecontainer0001")
+  elif command == "cp" and args[2] != "-":
+    # Older installers copy into a folder instead of reading the tar stream
+    with tarfile.open(config["docker_archive"]) as archive_tar:
+      member = archive_tar.getmembers()[0]
+      target_path = os.path.join(args[2], member.name) if os.path.isdir(args[2]) else args[2]
+      with open(target_path, "wb") as target_file:
+        shutil.copyfileobj(archive_tar.extractfile(member), target_file)
+  elif command == "cp":
+    with open(config["docker_archive"], "rb") as archive_file:
+      shutil.copyfileobj(archive_file, stdout)
+  elif command == "save":
+    write_payload(args[2], (args[3] + "\n").encode(), config["image_bytes"])
+  elif command == "load":
+    with open(args[2], "rb") as archive_file:
+      image_ref = archive_file.readline().decode().strip()
+      while archive_file.read(1048576):
+        pass
+    update_images(lambda images: add_image(images, image_ref, None))
+  elif command == "run":
+    time.sleep(config["gpu_probe_seconds"])
+    print("GPU 0: Fake GPU")
+  return 0
+
+# Serves the Docker Engine API calls of the installer on a unix socket, from
+# the same image store as the stand-in docker CLI
+def dockerd():
+  try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs, unquote
+  except ImportError:
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+  class EngineHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *log_args):
+      pass
+
+    def send_body(self, status, data, content_type="application/json"):
+      body = data if content_type != "application/json" else json.dumps(data).encode()
+      self.send_response(status)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def send_chunks(self, content_type, chunks):
+      self.send_response(200)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Transfer-Encoding", "chunked")
+      self.end_headers()
+      for chunk in chunks:
+        self.wfile.write(("%x\r\n" % len(chunk)).encode() + chunk + b"\r\n")
+        self.wfile.flush()
+      self.wfile.write(b"0\r\n\r\n")
+
+    def pull_messages(self, image_ref):
+      layers = ["%012x" % (0xa1b2c3d4e5f0 + i) for i in range(config["layers"])]
+      layer_bytes = config["image_bytes"] // len(layers)
+      steps = 20
+      for step in range(1, steps + 1):
+        for layer in layers:
+          yield (json.dumps({"id": layer, "status": "Downloading", "progressDetail": {"current": layer_bytes * step // steps, "total": layer_bytes}}) + "\r\n").encode()
+        time.sleep(config["pull_seconds"] / steps)
+      repo_digest = image_ref.rsplit(":", 1)[0] + "@sha256:" + hashlib.sha256(("manifest " + image_ref).encode()).hexdigest()
+      update_images(lambda images: add_image(images, image_ref, repo_digest))
+      yield (json.dumps({"status": "Status: Downloaded newer image for " + image_ref}) + "\r\n").encode()
+
+    def archive_chunks(self):
+      with open(config["docker_archive"], "rb") as archive_file:
+        chunk = archive_file.read(1048576)
+        while chunk:
+          yield chunk
+          chunk = archive_file.read(1048576)
+
+    def handle_request(self, method):
+      url = urlparse(self.path)
+      path = unquote(url.path)
+      params = dict((name, values[0]) for name, values in parse_qs(url.query).items())
+      self.rfile.read(int(self.headers.get("Content-Length") or 0))
+      with open(os.path.join(state_dir, "calls.txt"), "a") as calls_file:
+        calls_file.write("engine " + method + " " + path + "\n")
+      if method == "GET" and path == "/_ping":
+        self.send_body(200, b"OK", "text/plain")
+      elif method == "GET" and path == "/images/json":
+        references = json.loads(params.get("filters", "{}")).get("reference", [])
+        images = update_images(lambda images: list(images.values()))
+        self.send_body(200, [image for image in images if not references or
+                             any(repo_tag.rsplit(":", 1)[0] in references or repo_tag in references for repo_tag in image["RepoTags"])])
+      elif method == "GET" and path.startswith("/images/") and path.endswith("/json"):
+        image_ref = path[len("/images/"):-len("/json")]
+        image = update_images(lambda images: find_image(images, image_ref))
+        if image == None:
+          self.send_body(404, {"message": "No such image: " + image_ref})
+        else:
+          self.send_body(200, image)
+      elif method == "POST" and path == "/images/create":
+        self.send_chunks("application/json", self.pull_messages(params["fromImage"] + ":" + params["tag"]))
+      elif method == "POST" and path.startswith("/images/") and path.endswith("/tag"):
+        image_ref = path[len("/images/"):-len("/tag")]
+        def tag(images):
+          image = find_image(images, image_ref)
+          if image != None:
+            add_tag(images, image, params["repo"] + ":" + params["tag"])
+          return image != None
+        if update_images(tag):
+          self.send_body(201, b"", "text/plain")
+        else:
+          self.send_body(404, {"message": "No such image: " + image_ref})
+      elif method == "DELETE" and path.startswith("/images/"):
+        image_ref = path[len("/images/"):]
+        def remove(images):
+          image = find_image(images, image_ref)
+          if image != None and image_ref == image["Id"]:
+            del images[image["Id"]]
+          elif image != None:
+            remove_tag(images, image, image_ref)
+          return image != None
+        if update_images(remove):
+          self.send_body(200, [{"Untagged": image_ref}])
+        else:
+          self.send_body(404, {"message": "No such image: " + image_ref})
+      elif method == "POST" and path == "/containers/create":
+        self.send_body(201, {"Id": "fakecontainer0001", "Warnings": []})
+      elif method == "GET" and path.endswith("/archive"):
+        self.send_chunks("application/x-tar", self.archive_chunks())
+      elif method == "DELETE" and path.startswith("/containers/"):
+        self.send_body(204, b"", "text/plain")
+      else:
+        self.send_body(404, {"message": "page not found"})
+
+    def do_GET(self):
+      self.handle_request("GET")
+
+    def do_POST(self):
+      self.handle_request("POST")
+
+    def do_DELETE(self):
+      self.handle_request("DELETE")
+
+  class EngineServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+  if os.path.exists(args[0]):
+    os.remove(args[0])
+  EngineServer(args[0], EngineHandler).serve_forever()
+  return 0
+
+def singularity():
+  command = args[0] if args else ""
+  if command == "--version":
+    print(config["singularity_version"])
+  elif command == "build" and args[1] == "--sandbox":
+    os.makedirs(os.path.join(args[2], "parabricks"))
+    shutil.copy(config["release_tarball"], os.path.join(args[2], "parabricks", os.path.basename(config["release_tarball"])))
+  elif command == "build":
+    with open(args[2]) as definition_file:
+      bootstrap = definition_file.readline().strip()
+    if bootstrap == "Bootstrap: docker":
+      show_pull_progress("Copying blob sha256:%s %.2f MiB / %.2f MiB")
+    shutil.copy(config["sif_image"], args[1])
+  elif command == "pull":
+    show_pull_progress("Copying blob sha256:%s %.2f MiB / %.2f MiB")
+    shutil.copy(config["simg_image"], config["arch"] + "-" + args[1].rsplit(":", 1)[1] + ".simg")
+  elif command == "image.create":
+    write_payload(args[1], b"", config["overlay_bytes"])
+  return 0
+
+if tool == "docker":
+  sys.exit(docker())
+elif tool == "dockerd":
+  sys.exit(dockerd())
+elif tool == "singularity":
+  sys.exit(singularity())
+sys.exit(0)
+'''
+
+def format_mb(size_bytes):
+  return "%.1f MB" % (size_bytes / 1048576.0)
+
+def median(values):
+  values = sorted(value for value in values if value != None)
+  if not values:
+    return None
+  middle = len(values) // 2
+  if len(values) % 2 == 1:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+def get_git_revision(path):
+  try:
+    with open(os.devnull, "w") as devnull:
+      revision = subprocess.check_output(["git", "-C", path, "rev-parse", "HEAD"], stderr=devnull, universal_newlines=True).strip()
+      dirty = subprocess.check_output(["git", "-C", path, "status", "--porcelain", "--", "installer.py"], stderr=devnull, universal_newlines=True).strip() != ""
+  except (OSError, subprocess.CalledProcessError):
+    return {"commit": None, "dirty": None}
+  return {"commit": revision, "dirty": dirty}
+
+# A minimal squashfs 4.0 writer: uncompressed data blocks, no fragments, one
+# uid. Enough for the installer to find and read the release tarball.
+def write_squashfs(squashfs_path, files, block_size=131072):
+  tree = {}
+  for image_path, source_path in files:
+    parts = image_path.strip("/").split("/")
+    node = tree
+    for part in parts[:-1]:
+      node = node.setdefault(part, {})
+    node[parts[-1]] = source_path
+  inodes = []
+
+  with open(squashfs_path, "wb") as squashfs_file:
+    squashfs_file.write(b"\0" * 96)
+
+    def add_file(source_path):
+      start = squashfs_file.tell()
+      block_sizes = []
+      with open(source_path, "rb") as source_file:
+        block = source_file.read(block_size)
+        while block:
+          squashfs_file.write(block)
+          block_sizes.append(len(block) | SQUASHFS_UNCOMPRESSED)
+          block = source_file.read(block_size)
+      return {"kind": "file", "start": start, "size": squashfs_file.tell() - start, "blocks": block_sizes}
+
+    def add_directory(node):
+      children = []
+      for name in sorted(node):
+        if isinstance(node[name], dict):
+          children.append((name, add_directory(node[name])))
+        else:
+          inodes.append(add_file(node[name]))
+          children.append((name, len(inodes) - 1))
+      inodes.append({"kind": "dir", "children": children})
+      return len(inodes) - 1
+
+    root = add_directory(tree)
+
+    def metadata_blocks(data):
+      blocks = b""
+      block_offsets = []
+      for position in range(0, max(len(data), 1), SQUASHFS_METADATA_SIZE):
+        chunk = data[position:position + SQUASHFS_METADATA_SIZE]
+        block_offsets.append(len(blocks))
+        blocks += struct.pack("<H", len(chunk) | 0x8000) + chunk
+      return blocks, block_offsets
+
+    inode_offsets = []
+    position = 0
+    for inode in inodes:
+      inode_offsets.append(position)
+      position += 32 if inode["kind"] == "dir" else 56 + 4 * len(inode["blocks"])
+
+    def inode_ref(index):
+      offset = inode_offsets[index]
+      return ((offset // SQUASHFS_METADATA_SIZE) * (SQUASHFS_METADATA_SIZE + 2)) << 16 | (offset % SQUASHFS_METADATA_SIZE)
+
+    directory_data = b""
+    listing_offsets = {}
+    for index, inode in enumerate(inodes):
+      if inode["kind"] != "dir":
+        continue
+      listing_offsets[index] = len(directory_data)
+      listing = b""
+      for name, child in inode["children"]:
+        child_ref = inode_ref(child)
+        encoded_name = name.encode()
+        listing += struct.pack("<IIi", 0, child_ref >> 16, child + 1)
+        listing += struct.pack("<HhHH", child_ref & 0xFFFF, 0, 1 if inodes[child]["kind"] == "dir" else 2, len(encoded_name) - 1) + encoded_name
+      inode["listing_size"] = len(listing)
+      directory_data += listing
+    directory_blocks, directory_offsets = metadata_blocks(directory_data)
+
+    inode_data = b""
+    for index, inode in enumerate(inodes):
+      if inode["kind"] == "dir":
+        listing_offset = listing_offsets[index]
+        inode_data += struct.pack("<HHHHII", 1, 0o755, 0, 0, 0, index + 1)
+        inode_data += struct.pack("<IIHHI", directory_offsets[listing_offset // SQUASHFS_METADATA_SIZE], 2, inode["listing_size"] + 3, listing_offset % SQUASHFS_METADATA_SIZE, 0)
+      else:
+        inode_data += struct.pack("<HHHHII", 9, 0o644, 0, 0, 0, index + 1)
+        inode_data += struct.pack("<QQQIIII", inode["start"], inode["size"], 0, 1, 0xFFFFFFFF, 0, 0xFFFFFFFF)
+        inode_data += struct.pack("<%dI" % len(inode["blocks"]), *inode["blocks"])
+    inode_blocks = metadata_blocks(inode_data)[0]
+
+    inode_table = squashfs_file.tell()
+    squashfs_file.write(inode_blocks)
+    directory_table = squashfs_file.tell()
+    squashfs_file.write(directory_blocks)
+    fragment_blocks_position = squashfs_file.tell()
+    fragment_blocks, fragment_offsets = metadata_blocks(b"")
+    squashfs_file.write(fragment_blocks)
+    fragment_table = squashfs_file.tell()
+    for fragment_offset in fragment_offsets:
+      squashfs_file.write(struct.pack("<Q", fragment_blocks_position + fragment_offset))
+    id_table = squashfs_file.tell()
+    squashfs_file.write(struct.pack("<Q", id_table + 8))
+    squashfs_file.write(struct.pack("<H", 0x8004) + b"\0" * 4)
+    bytes_used = squashfs_file.tell()
+    squashfs_file.seek(0)
+    squashfs_file.write(struct.pack("<4sIIIIHHHHHHQQQQQQQQ", b"hsqs", len(inodes), int(time.time()), block_size, 0,
+                                    1, block_size.bit_length() - 1, 0, 1, 4, 0, inode_ref(root), bytes_used, id_table,
+                                    0xFFFFFFFFFFFFFFFF, inode_table, directory_table, fragment_table, 0xFFFFFFFFFFFFFFFF))
+
+def write_sif(sif_path, squashfs_path):
+  squashfs_size = os.path.getsize(squashfs_path)
+  definition = b"Bootstrap: docker\n"
+  descriptor_size = struct.calcsize(SIF_DESCRIPTOR_FORMAT)
+  descriptors_offset = 128
+  data_offset = descriptors_offset + 2 * descriptor_size
+  partition_offset = data_offset + len(definition)
+  descriptors = struct.pack(SIF_DESCRIPTOR_FORMAT, 0x4001, 1, 1, 0, 0, data_offset, len(definition), len(definition), 0, 0, 0, 0, b"", b"")
+  descriptors += struct.pack(SIF_DESCRIPTOR_FORMAT, 0x4004, 1, 2, 0, 0, partition_offset, squashfs_size, squashfs_size, 0, 0, 0, 0, b"",
+                             struct.pack("<ii3s", 1, 2, b"01"))
+  header = b"#!/usr/bin/env run-singularity\n".ljust(32, b"\0") + b"SIF_MAGIC\0" + b"01\0" + b"01\0" + uuid.uuid4().bytes
+  header += struct.pack("<qqqqqqqq", 0, 0, 0, 2, descriptors_offset, 2 * descriptor_size, data_offset, len(definition) + squashfs_size)
+  with open(sif_path, "wb") as sif_file:
+    sif_file.write(header + descriptors + definition)
+    with open(squashfs_path, "rb") as squashfs_file:
+      shutil.copyfileobj(squashfs_file, sif_file)
+
+def write_simg(simg_path, squashfs_path):
+  with open(simg_path, "wb") as simg_file:
+    simg_file.write(b"#!/usr/bin/env run-singularity\n")
+    with open(squashfs_path, "rb") as squashfs_file:
+      shutil.copyfileobj(squashfs_file, simg_file)
+
+# The release tarball has a pbrun stand-in and bench_args.files generated
+# scripts. The content only depends on the options, so it is the same for
+# every commit that is benchmarked.
+def write_payloads(bench_args, payload_dir):
+  release_name = "release-" + bench_args.release
+  release_dir = os.path.join(payload_dir, release_name)
+  rng = random.Random(bench_args.seed)
+  os.makedirs(release_dir)
+  with open(os.path.join(release_dir, "pbrun"), "w") as pbrun_file:
+    pbrun_file.write("#!/bin/sh\necho \"pbrun " + bench_args.release + "\"\n")
+  os.chmod(os.path.join(release_dir, "pbrun"), 0o755)
+  for i in range(bench_args.files):
+    script_dir = os.path.join(release_dir, "tool%02d" % (i % 40))
+    if not os.path.isdir(script_dir):
+      os.makedirs(script_dir)
+    script_line = "print('parabricks script %d')\n" % i
+    with open(os.path.join(script_dir, "script%05d.py" % i), "w") as script_file:
+      script_file.write(script_line * (rng.randint(bench_args.file_size // 2, bench_args.file_size * 3 // 2) // len(script_line) + 1))
+
+  release_tarball = os.path.join(payload_dir, release_name + ".tar.gz")
+  with tarfile.open(release_tarball, "w:gz") as release_tar:
+    release_tar.add(release_dir, release_name)
+  shutil.rmtree(release_dir)
+  docker_archive = os.path.join(payload_dir, "docker_cp.tar")
+  with tarfile.open(docker_archive, "w") as archive_tar:
+    archive_tar.add(release_tarball, release_name + ".tar.gz")
+
+  image_filler = os.path.join(payload_dir, "filler.bin")
+  with open(image_filler, "wb") as filler_file:
+    filler_file.write(b"\0" * (bench_args.image_mb * 1048576))
+  squashfs_path = os.path.join(payload_dir, "image.squashfs")
+  write_squashfs(squashfs_path, [("parabricks/" + release_name + ".tar.gz", release_tarball), ("opt/filler.bin", image_filler)])
+  write_sif(os.path.join(payload_dir, "image.sif"), squashfs_path)
+  write_simg(os.path.join(payload_dir, "image.simg"), squashfs_path)
+  os.remove(squashfs_path)
+  os.remove(image_filler)
+  return {"release_tarball": release_tarball, "docker_archive": docker_archive,
+          "sif_image": os.path.join(payload_dir, "image.sif"), "simg_image": os.path.join(payload_dir, "image.simg")}
+
+def write_fake_tools(bin_dir):
+  os.makedirs(bin_dir)
+  runtime_path = os.path.join(bin_dir, "fake_runtime")
+  with open(runtime_path, "w") as runtime_file:
+    runtime_file.write("#!" + sys.executable + "\n" + FAKE_RUNTIME)
+  os.chmod(runtime_path, 0o755)
+  for tool in ["docker", "dockerd", "singularity", "curl"]:
+    os.symlink(runtime_path, os.path.join(bin_dir, tool))
+
+# Options the installer accepts, so older commits are benchmarked without the
+# ones added later. Hidden options (argparse.SUPPRESS) are missing from --help,
+# so they are read from the add_argument calls.
+def get_installer_options(installer_path):
+  with open(installer_path) as installer_file:
+    return set(re.findall(r'add_argument\("(--[a-z0-9-]+)"', installer_file.read()))
+
+def get_tree_size(path):
+  total = 0
+  for dir_path, dir_names, file_names in os.walk(path):
+    for file_name in file_names:
+      try:
+        total += os.lstat(os.path.join(dir_path, file_name)).st_size
+      except OSError:
+        pass
+  return total
+
+def parse_proc_io(io_text):
+  counters = {}
+  try:
+    for io_line in io_text.splitlines():
+      name, value = io_line.split(":", 1)
+      counters[name.strip()] = int(value)
+  except ValueError:
+    pass
+  return counters
+
+def read_proc_io(io_path):
+  try:
+    with open(io_path) as io_file:
+      return parse_proc_io(io_file.read())
+  except (IOError, OSError):
+    return {}
+
+# Returns the installer's own counters at exit and the counters of the children
+# it reaped, see IO_BOOTSTRAP
+def read_installer_io(io_path):
+  try:
+    with open(io_path) as io_file:
+      installer_io = json.load(io_file)
+  except (IOError, OSError, ValueError):
+    return {}, []
+  children = [{"time": child["time"], "io": parse_proc_io(child["io"])} for child in installer_io["children"]]
+  return subtract_io(parse_proc_io(installer_io["io"]), children), children
+
+def subtract_io(counters, children):
+  if not counters:
+    return {}
+  return dict((name, counters.get(name, 0) - sum(child["io"].get(name, 0) for child in children)) for name in IO_COUNTERS)
+
+# Samples the installer's /proc/<pid>/io and the size of its TMPDIR while it
+# runs, so counters and temporary space can be attributed to install phases.
+# The sampled counters include the children reaped up to the sample, which
+# io_delta subtracts once the run is over.
+class RunSampler(object):
+  def __init__(self, pid, tmp_dir, interval):
+    self.pid = pid
+    self.tmp_dir = tmp_dir
+    self.interval = interval
+    self.samples = []
+    self.children = []
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    while not self.stopped.is_set():
+      sample_time = time.time()
+      io_counters = read_proc_io("/proc/%d/io" % self.pid)
+      self.samples.append({"time": sample_time, "tmp_bytes": get_tree_size(self.tmp_dir), "io": io_counters})
+      self.stopped.wait(self.interval)
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+
+  def peak_tmp(self, start=None, end=None):
+    sizes = [sample["tmp_bytes"] for sample in self.samples if (start == None or sample["time"] >= start) and (end == None or sample["time"] <= end)]
+    return max(sizes or [0])
+
+  def io_delta(self, start, end):
+    before = [sample for sample in self.samples if sample["time"] <= start and sample["io"]]
+    after = [sample for sample in self.samples if sample["time"] >= end and sample["io"]]
+    if not before or not after:
+      return {}
+    reaped = [child for child in self.children if before[-1]["time"] < child["time"] <= after[0]["time"]]
+    delta = dict((name, after[0]["io"].get(name, 0) - before[-1]["io"].get(name, 0)) for name in IO_COUNTERS)
+    return subtract_io(delta, reaped)
+
+def get_phase_results(timeline, sampler):
+  phases = {}
+  for record in timeline.get("phases", []):
+    phase = phases.setdefault(record["name"], {"seconds": 0.0, "bytes": 0, "exit_code": 0, "peak_tmp_bytes": 0})
+    phase["seconds"] += record["seconds"]
+    phase["bytes"] += record["bytes"]
+    phase["exit_code"] = phase["exit_code"] or record["exit_code"]
+    phase["peak_tmp_bytes"] = max(phase["peak_tmp_bytes"], sampler.peak_tmp(record["start"], record["end"]))
+    for name, value in sampler.io_delta(record["start"], record["end"]).items():
+      phase[name] = phase.get(name, 0) + value
+  return phases
+
+def remove_installer_logs(start_time, end_time):
+  for log_path in glob.glob("/tmp/pb_install_log_*.txt"):
+    try:
+      log_time = float(os.path.basename(log_path)[len("pb_install_log_"):-len(".txt")])
+    except ValueError:
+      continue
+    if start_time - 1 <= log_time <= end_time:
+      timeline_path = log_path.replace("pb_install_log_", "pb_install_timeline_").replace(".txt", ".json")
+      for removed_path in [log_path, timeline_path, timeline_path.replace(".json", ".trace.json")]:
+        if os.path.exists(removed_path):
+          os.remove(removed_path)
+
+class Bench(object):
+  def __init__(self, bench_args, work_dir):
+    self.args = bench_args
+    self.work_dir = work_dir
+    self.bin_dir = os.path.join(work_dir, "bin")
+    self.package_dir = os.path.join(work_dir, "package")
+    os.makedirs(self.package_dir)
+    write_fake_tools(self.bin_dir)
+    self.payloads = write_payloads(bench_args, os.path.join(work_dir, "payload"))
+    shutil.copy(bench_args.installer, os.path.join(self.package_dir, "installer.py"))
+    self.installer_options = get_installer_options(bench_args.installer)
+    with open(os.path.join(self.package_dir, "EULA.txt"), "w") as eula_file:
+      eula_file.write("Benchmark stand-in EULA\n")
+    with open(os.path.join(self.package_dir, "license.bin"), "w") as license_file:
+      license_file.write("benchmark\n")
+
+  def get_config(self, scenario):
+    config = {"latency": self.args.latency, "pull_seconds": self.args.pull_seconds, "gpu_probe_seconds": self.args.gpu_probe_seconds,
+              "image_bytes": self.args.image_mb * 1048576, "layers": 4, "overlay_bytes": 1048576, "arch": "x86_64",
+              "singularity_version": scenario.get("singularity_version", "singularity version 3.5.3")}
+    config.update(self.payloads)
+    return config
+
+  # Returns the options a scenario needs that the benchmarked installer does
+  # not have, e.g. --verify before it was added
+  def get_missing_options(self, scenario):
+    needed_options = scenario.get("requires_options", []) + [arg for scenario_args in [scenario["args"]] + scenario.get("prepare", [])
+                                                              for arg in scenario_args if arg.startswith("--")]
+    return sorted(set(option for option in needed_options if option not in self.installer_options))
+
+  # Starts the stand-in dockerd and waits until its socket accepts connections
+  def start_engine(self, state_dir):
+    socket_path = os.path.join(state_dir, "docker.sock")
+    environ = os.environ.copy()
+    environ["PB_BENCH_STATE"] = state_dir
+    engine_proc = subprocess.Popen([os.path.join(self.bin_dir, "dockerd"), socket_path], env=environ)
+    deadline = time.time() + 10
+    while True:
+      probe_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        probe_socket.connect(socket_path)
+        return engine_proc, socket_path
+      except socket.error:
+        if engine_proc.poll() != None or time.time() > deadline:
+          engine_proc.kill()
+          raise RuntimeError("The stand-in dockerd did not start on " + socket_path)
+        time.sleep(0.01)
+      finally:
+        probe_socket.close()
+
+  # Every run has its own HOME, so no run reuses preflight results cached by
+  # another one (e.g. the singularity version of a different scenario)
+  def run_installer(self, run_dir, installer_args, measured, engine_socket=None):
+    state_dir = os.path.join(run_dir, "state")
+    tmp_dir = os.path.join(run_dir, "tmp")
+    home_dir = os.path.join(run_dir, "home")
+    for run_subdir in [tmp_dir, home_dir]:
+      if not os.path.isdir(run_subdir):
+        os.makedirs(run_subdir)
+    environ = os.environ.copy()
+    environ.pop("DOCKER_HOST", None)
+    environ.update({"PATH": self.bin_dir + os.pathsep + environ.get("PATH", ""), "PB_BENCH_STATE": state_dir,
+                    "HOME": home_dir, "TMPDIR": tmp_dir, "PYTHONUNBUFFERED": "1"})
+    if engine_socket != None:
+      environ["DOCKER_HOST"] = "unix://" + engine_socket
+    io_path = os.path.join(run_dir, "installer_io.txt")
+    cmd_line = [sys.executable, "-c", IO_BOOTSTRAP, io_path, os.path.join(self.package_dir, "installer.py")] + installer_args
+    rusage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time = time.time()
+    with open(os.path.join(run_dir, "installer_output.txt"), "a") as output_file:
+      cmd_proc = subprocess.Popen(cmd_line, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=environ, cwd=run_dir, universal_newlines=True)
+      sampler = RunSampler(cmd_proc.pid, tmp_dir, self.args.sample_interval)
+      output = cmd_proc.communicate("")[0]
+      end_time = time.time()
+      sampler.stop()
+      output_file.write(output)
+    rusage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    installer_io, sampler.children = read_installer_io(io_path)
+    result = {"exit_code": cmd_proc.returncode, "seconds": end_time - start_time, "io": installer_io,
+              "peak_tmp_bytes": sampler.peak_tmp(),
+              "cpu_seconds": (rusage_after.ru_utime - rusage_before.ru_utime) + (rusage_after.ru_stime - rusage_before.ru_stime),
+              "block_writes": rusage_after.ru_oublock - rusage_before.ru_oublock, "phases": {}}
+    timeline_match = TIMELINE_LINE.search(output)
+    if timeline_match != None and os.path.exists(timeline_match.group(1)):
+      with open(timeline_match.group(1)) as timeline_file:
+        result["phases"] = get_phase_results(json.load(timeline_file), sampler)
+    remove_installer_logs(start_time, end_time)
+    if measured == False and cmd_proc.returncode != 0:
+      raise RuntimeError("installer.py " + " ".join(installer_args) + " failed, see " + os.path.join(run_dir, "installer_output.txt"))
+    return result, output
+
+  def run_scenario(self, scenario_name, run_index):
+    scenario = SCENARIOS[scenario_name]
+    run_dir = os.path.join(self.work_dir, "runs", scenario_name + "-" + str(run_index))
+    state_dir = os.path.join(run_dir, "state")
+    os.makedirs(state_dir)
+    with open(os.path.join(state_dir, "config.json"), "w") as config_file:
+      json.dump(self.get_config(scenario), config_file)
+    install_root = os.path.join(run_dir, "install")
+    common_args = ["--force", "--arch", "x86_64", "--release", self.args.release, "--install-location", install_root]
+    # Installers before --docker-cli only have the CLI path
+    if "--docker-cli" in self.installer_options and scenario.get("engine_api") != True:
+      common_args.append("--docker-cli")
+    if scenario.get("seed_images"):
+      images = {}
+      for i in range(self.args.old_images):
+        image_id = "sha256:%064x" % (i + 1)
+        images[image_id] = {"Id": image_id, "Size": self.args.image_mb * 1048576, "RepoTags": ["parabricks/release:v0.%d.0" % i], "RepoDigests": []}
+      with open(os.path.join(state_dir, "images.json"), "w") as images_file:
+        json.dump(images, images_file)
+    engine_proc, engine_socket = None, None
+    if scenario.get("engine_api") == True:
+      engine_proc, engine_socket = self.start_engine(state_dir)
+    try:
+      for prepare_args in scenario.get("prepare", []):
+        self.run_installer(run_dir, common_args + prepare_args, False, engine_socket)
+      calls_path = os.path.join(state_dir, "calls.txt")
+      if os.path.exists(calls_path):
+        os.remove(calls_path)
+      result, output = self.run_installer(run_dir, common_args + scenario["args"], True, engine_socket)
+    finally:
+      if engine_proc != None:
+        engine_proc.terminate()
+        engine_proc.wait()
+    # A failed run is reported as failed, e.g. a bug of an older installer
+    if result["exit_code"] == 0:
+      check_scenario_path(scenario_name, scenario, calls_path, output)
+    result["run"] = run_index
+    if self.args.keep_work_dir == False:
+      shutil.rmtree(run_dir, True)
+    return result
+
+# expect_calls must match a stand-in tool call of the measured run and
+# expect_output its output, so a run that takes a different install path than
+# the one its scenario measures fails the benchmark instead of skewing it
+SCENARIOS = {
+  "docker": {"args": [], "expect_calls": r"^docker pull "},
+  "docker-engine": {"args": [], "engine_api": True, "requires_options": ["--docker-cli"], "expect_calls": r"^engine POST /images/create"},
+  "singularity-3": {"args": ["--container", "singularity"], "requires_root": True, "expect_calls": r"^singularity build \S+\.sif "},
+  "singularity-2": {"args": ["--container", "singularity"], "singularity_version": "2.6.1-dist", "expect_calls": r"^singularity pull docker://"},
+  "uninstall": {"prepare": [[]], "args": ["--uninstall"], "expect_calls": r"^docker rmi parabricks/release:"},
+  "uninstall-legacy": {"seed_images": True, "args": ["--uninstall"], "expect_calls": r"^docker rmi parabricks/release:v0\.0\.0"},
+  "verify": {"prepare": [[]], "args": ["--verify"], "expect_output": r": OK, \d+ scripts verified"},
+}
+
+def check_scenario_path(scenario_name, scenario, calls_path, output):
+  calls = ""
+  if os.path.exists(calls_path):
+    with open(calls_path) as calls_file:
+      calls = calls_file.read()
+  for pattern, text in [(scenario.get("expect_calls"), calls), (scenario.get("expect_output"), output)]:
+    if pattern != None and re.search(pattern, text, re.M) == None:
+      raise RuntimeError(scenario_name + " did not take the install path it measures, nothing matched " + pattern + ". Rerun with --keep-work-dir to keep the installer output")
+
+def summarize(runs):
+  summary = {"seconds": median([run["seconds"] for run in runs]), "peak_tmp_bytes": median([run["peak_tmp_bytes"] for run in runs]),
+             "cpu_seconds": median([run["cpu_seconds"] for run in runs]), "phases": {}}
+  for name in IO_COUNTERS:
+    summary[name] = median([run["io"].get(name) for run in runs])
+  for phase_name in sorted(set(phase_name for run in runs for phase_name in run["phases"])):
+    phase_runs = [run["phases"][phase_name] for run in runs if phase_name in run["phases"]]
+    summary["phases"][phase_name] = dict((name, median([phase.get(name) for phase in phase_runs]))
+                                         for name in ["seconds", "bytes", "peak_tmp_bytes", "wchar", "syscw"])
+  return summary
+
+def format_summary(scenario_name, summary):
+  lines = ["%-22s %8.2fs  written %10s  write syscalls %7d  peak tmp %10s" % (scenario_name, summary["seconds"], format_mb(summary["wchar"] or 0), summary["syscw"] or 0, format_mb(summary["peak_tmp_bytes"] or 0))]
+  for phase_name, phase in sorted(summary["phases"].items()):
+    lines.append("  %-20s %8.2fs  written %10s  write syscalls %7d  peak tmp %10s" % (phase_name, phase["seconds"], format_mb(phase["wchar"] or 0), phase["syscw"] or 0, format_mb(phase["peak_tmp_bytes"] or 0)))
+  return "\n".join(lines)
+
+def format_comparison(old_results, new_results):
+  lines = ["%-34s %10s %10s %8s" % ("Scenario / phase", "before", "after", "change")]
+  def compare(label, old_seconds, new_seconds):
+    if old_seconds == None or new_seconds == None:
+      return
+    change = "n/a"
+    if old_seconds > 0:
+      change = "%+.0f%%" % ((new_seconds - old_seconds) * 100.0 / old_seconds)
+    lines.append("%-34s %9.2fs %9.2fs %8s" % (label, old_seconds, new_seconds, change))
+  for scenario_name, new_scenario in sorted(new_results["scenarios"].items()):
+    old_scenario = old_results.get("scenarios", {}).get(scenario_name)
+    if old_scenario == None or "summary" not in old_scenario or "summary" not in new_scenario:
+      continue
+    compare(scenario_name, old_scenario["summary"]["seconds"], new_scenario["summary"]["seconds"])
+    for phase_name, phase in sorted(new_scenario["summary"]["phases"].items()):
+      old_phase = old_scenario["summary"]["phases"].get(phase_name)
+      if old_phase != None:
+        compare("  " + phase_name, old_phase["seconds"], phase["seconds"])
+  return "\n".join(lines)
+
+def get_bench_args():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--installer", help="installer.py to benchmark", default=os.path.join(SCRIPT_DIR, "installer.py"))
+  parser.add_argument("--scenarios", help="Comma separated scenarios to run, out of " + ", ".join(sorted(SCENARIOS)), default=",".join(sorted(SCENARIOS)))
+  parser.add_argument("--repeat", help="Runs per scenario, results report the median", type=int, default=3)
+  parser.add_argument("--release", help="Release version of the generated payloads", default="v2.5.0")
+  parser.add_argument("--files", help="Number of scripts in the generated release tarball", type=int, default=3000)
+  parser.add_argument("--file-size", help="Average size of the generated scripts in bytes", type=int, default=4096)
+  parser.add_argument("--image-mb", help="Size of the fake image in MB", type=int, default=64)
+  parser.add_argument("--pull-seconds", help="Time a fake image pull takes", type=float, default=2.0)
+  parser.add_argument("--latency", help="Start up time of every fake docker/singularity/curl call in seconds", type=float, default=0.02)
+  parser.add_argument("--gpu-probe-seconds", help="Time the fake nvidia-smi container takes", type=float, default=0.5)
+  parser.add_argument("--old-images", help="Number of old parabricks images for the uninstall-legacy scenario", type=int, default=20)
+  parser.add_argument("--sample-interval", help="Seconds between samples of the installer's I/O counters and temporary space", type=float, default=0.02)
+  parser.add_argument("--seed", help="Random seed for the generated payloads", type=int, default=1)
+  parser.add_argument("--output", help="JSON result file", default="bench_output.txt")
+  parser.add_argument("--compare", help="Earlier JSON result file to compare against", default=None)
+  parser.add_argument("--work-dir", help="Directory for payloads and installs, a new temporary directory by default", default=None)
+  parser.add_argument("--keep-work-dir", help="Keep the payloads, installs and installer output", action='store_true', default=False)
+  bench_args = parser.parse_args()
+  for scenario_name in bench_args.scenarios.split(","):
+    if scenario_name not in SCENARIOS:
+      parser.error("unknown scenario " + scenario_name)
+  return bench_args
+
+if __name__ == '__main__':
+  bench_args = get_bench_args()
+  bench_args.installer = os.path.realpath(bench_args.installer)
+  work_dir = bench_args.work_dir
+  if work_dir == None:
+    work_dir = tempfile.mkdtemp(prefix="pb_bench_")
+  else:
+    work_dir = os.path.realpath(work_dir)
+    os.makedirs(work_dir)
+  print("Generating payloads in " + work_dir)
+  bench = Bench(bench_args, work_dir)
+
+  results = {"git": get_git_revision(os.path.dirname(bench_args.installer)), "host": socket.gethostname(),
+             "python": sys.version.split()[0], "time": time.time(), "scenarios": {},
+             "options": dict((name, value) for name, value in vars(bench_args).items() if name not in ["output", "compare", "work_dir", "keep_work_dir"])}
+  try:
+    for scenario_name in bench_args.scenarios.split(","):
+      if SCENARIOS[scenario_name].get("requires_root") == True and os.getuid() != 0:
+        print(scenario_name + ": skipped, needs root")
+        results["scenarios"][scenario_name] = {"skipped": "needs root"}
+        continue
+      missing_options = bench.get_missing_options(SCENARIOS[scenario_name])
+      if missing_options:
+        print(scenario_name + ": skipped, installer.py has no " + " ".join(missing_options))
+        results["scenarios"][scenario_name] = {"skipped": "installer.py has no " + " ".join(missing_options)}
+        continue
+      runs = [bench.run_scenario(scenario_name, run_index) for run_index in range(bench_args.repeat)]
+      results["scenarios"][scenario_name] = {"runs": runs, "summary": summarize(runs)}
+      failed_runs = [run["run"] for run in runs if run["exit_code"] != 0]
+      print(format_summary(scenario_name, results["scenarios"][scenario_name]["summary"]))
+      if failed_runs:
+        print("  runs " + ", ".join(str(run_index) for run_index in failed_runs) + " failed")
+  finally:
+    if bench_args.keep_work_dir == False:
+      shutil.rmtree(work_dir, True)
+
+  with open(bench_args.output, "w") as output_file:
+    json.dump(results, output_file, indent=2, sort_keys=True)
+  print("Results written to " + bench_args.output)
+  if bench_args.compare != None:
+    with open(bench_args.compare) as compare_file:
+      print("\n" + format_comparison(json.load(compare_file), results))
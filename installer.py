@@ -8,10 +8,77 @@ import errno
 import textwrap
 import shutil
 import time
-from distutils.dir_util import copy_tree
+import json
+import threading
+import tarfile
+import struct
+import zlib
+import hashlib
+import fcntl
+import contextlib
+import tempfile
+import atexit
+import socket
+import re
+import base64
+try:
+  from shutil import which as find_executable
+except ImportError:
+  from distutils.spawn import find_executable
+try:
+  import lzma
+except ImportError:
+  lzma = None
+try:
+  import pty
+except ImportError:
+  pty = None
+try:
+  import ctypes
+except ImportError:
+  ctypes = None
+try:
+  from shlex import quote as shell_quote
+except ImportError:
+  from pipes import quote as shell_quote
+try:
+  import http.client as httplib
+  from urllib.parse import quote, urlencode
+except ImportError:
+  import httplib
+  from urllib import quote, urlencode
 
 NVIDIA_DOCKER = "docker"
 #NVIDIA_DOCKER = "nvidia-docker"
+PREFLIGHT_CACHE_FILE = os.path.expanduser("~/.parabricks/preflight_cache.json")
+PULLED_IMAGES_FILE = os.path.expanduser("~/.parabricks/docker_images.json")
+INVENTORY_FILE = "parabricks-inventory.json"
+
+SIF_MAGIC = b"SIF_MAGIC"
+SIF_DATA_PARTITION = 0x4004
+SIF_FS_SQUASH = 1
+SIF_PART_PRIMSYS = 2
+SIF_DESCRIPTOR_FORMAT = "<iBIIIqqqqqqq128s384s"
+SQUASHFS_MAGIC = b"hsqs"
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+DOCKER_LAYER_PROGRESS = re.compile(r"^([0-9a-f]{12}): Downloading\s.*?([\d.]+)\s*([kKMGT]?i?[bB])/([\d.]+)\s*([kKMGT]?i?[bB])")
+DOCKER_LAYER_STATUS = re.compile(r"^([0-9a-f]{12}): ")
+SINGULARITY_BLOB_PROGRESS = re.compile(r"Copying blob\s+(?:sha256:)?([0-9a-f]{6,}).*?([\d.]+)\s*([kKMGT]?i?[bB])\s*/\s*([\d.]+)\s*([kKMGT]?i?[bB])")
+SINGULARITY_BLOB_STATUS = re.compile(r"Copying blob\s+(?:sha256:)?([0-9a-f]{6,})")
+PULL_LOG_SAMPLE_SECONDS = 5
+DOCKER_SOCKET = "/var/run/docker.sock"
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+FLEET_OPTIONS = ["--fleet", "--fleet-workers", "--fleet-transport", "--fleet-retries", "--fleet-timeout"]
+FLEET_PHASES = ["preflight", "pull", "script extraction", "verify"]
+
+prefetch_job = None
+docker_engine = False
+log_lock = threading.Lock()
+step_context = threading.local()
+script_manifest = {}
+expected_image = {}
 
 def GetUserDecision():
   inputVar = input
@@ -33,6 +100,7 @@ def GetUserAgreement():
     print("python installery.py -h to see available installation options")
     print("If you have not received EULA.txt or have any other questions")
     print("Contact Parabricks-Support@nvidia.com for any questions\n")
+    cancel_prefetch()
     sys.exit(0)
 
 def GetEULAAgreement(scriptDir, runArgs):
@@ -65,8 +133,85 @@ def GetHostFile(inputName):
   else:
     return os.path.abspath(os.getcwd() + '/' + inputName)
 
+# Records wall time, exit code and bytes moved for each install phase. Phases
+# are tracked per thread, so run_and_return() can attribute exit codes to the
+# phase of the step that ran the command.
+class InstallTimeline(object):
+  def __init__(self):
+    self.start_time = time.time()
+    self.phases = []
+    self.lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def phase(self, phase_name):
+    record = {"name": phase_name, "start": time.time(), "end": None, "seconds": None, "exit_code": 0, "bytes": 0}
+    step = getattr(step_context, "step", None)
+    if step != None:
+      record["step"] = step.name
+    parent_phase = getattr(step_context, "phase", None)
+    step_context.phase = record
+    try:
+      yield record
+    except BaseException:
+      if record["exit_code"] == 0:
+        record["exit_code"] = -1
+      raise
+    finally:
+      step_context.phase = parent_phase
+      record["end"] = time.time()
+      record["seconds"] = record["end"] - record["start"]
+      with self.lock:
+        self.phases.append(record)
+
+  def record_exit_code(self, exit_code):
+    record = getattr(step_context, "phase", None)
+    if record != None and exit_code != 0:
+      record["exit_code"] = exit_code
+
+  def to_json(self):
+    phases = sorted(self.phases, key=lambda record: record["start"])
+    for record in phases:
+      record["offset"] = record["start"] - self.start_time
+    return {"host": socket.gethostname(), "release": install_args.release, "container": install_args.container,
+            "arch": install_args.arch, "start": self.start_time, "seconds": time.time() - self.start_time,
+            "exit_code": max([0] + [abs(record["exit_code"]) for record in phases]), "phases": phases}
+
+  def to_chrome_trace(self):
+    events = []
+    thread_ids = {}
+    for record in sorted(self.phases, key=lambda record: record["start"]):
+      thread_id = thread_ids.setdefault(record.get("step", "main"), len(thread_ids) + 1)
+      events.append({"name": record["name"], "ph": "X", "pid": 1, "tid": thread_id,
+                     "ts": int((record["start"] - self.start_time) * 1e6), "dur": int(record["seconds"] * 1e6),
+                     "args": {"exit_code": record["exit_code"], "bytes": record["bytes"]}})
+    for step_name, thread_id in thread_ids.items():
+      events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": thread_id, "args": {"name": step_name}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+  def write(self, log_path, chrome_trace):
+    if not self.phases:
+      return
+    if install_args.fleet_node == True:
+      print("PB_TIMELINE " + json.dumps(self.to_json()))
+    timeline_path = log_path.replace("pb_install_log_", "pb_install_timeline_").replace(".txt", ".json")
+    write_json_atomic(timeline_path, self.to_json())
+    print("Install timeline written to " + timeline_path)
+    if chrome_trace == True:
+      trace_path = timeline_path.replace(".json", ".trace.json")
+      write_json_atomic(trace_path, self.to_chrome_trace())
+      print("Chrome trace written to " + trace_path)
+
+timeline = InstallTimeline()
+
+class InstallError(Exception):
+  pass
+
 def InstallAbort():
+  # Inside a scheduled step only that step fails, the scheduler rolls back and aborts
+  if getattr(step_context, "step", None) != None:
+    raise InstallError(step_context.step.name + " failed")
   print("Contact support@parabricks.com for troubleshooting")
+  cancel_prefetch()
   if install_args.container == "docker":
     if subprocess.call("command -v docker", shell=True) == 0:
       if install_args.ngc == False:
@@ -75,85 +220,519 @@ def InstallAbort():
   sys.exit(-1)
 
 
-def run_and_return(cmd_line, err_mesg, shell_var=False, on_screen=False, environ=os.environ.copy()):
+# Lines logged from a scheduled step are prefixed with the step name
+def write_log(log_text):
+  step = getattr(step_context, "step", None)
+  if step != None:
+    log_text = "".join("[" + step.name + "] " + log_line for log_line in log_text.splitlines(True))
+  with log_lock:
+    log_file.write(log_text)
+    log_file.flush()
+
+def run_and_return(cmd_line, err_mesg, shell_var=False, on_screen=False, environ=os.environ.copy(), cwd=None):
   #print cmd_line
-  cmd_log_file = log_file
+  step = getattr(step_context, "step", None)
+  if shell_var == True:
+    write_log("+ " + cmd_line + "\n")
+  else:
+    write_log("+ " + " ".join(cmd_line) + "\n")
   if on_screen == True:
-    cmd_log_file = None
-  log_file.write("+ " + " ".join(cmd_line) + "\n")
-  log_file.flush()
-  cmd_return_code = subprocess.call(cmd_line, stdout = cmd_log_file, stderr = cmd_log_file, shell=shell_var, env=environ)
+    cmd_proc = subprocess.Popen(cmd_line, shell=shell_var, env=environ, cwd=cwd)
+  else:
+    cmd_proc = subprocess.Popen(cmd_line, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, shell=shell_var, env=environ, cwd=cwd, universal_newlines=True)
+  if step != None:
+    step.scheduler.track_process(cmd_proc)
+  if on_screen == False:
+    # Stream output line by line so concurrent steps stay readable in the log
+    for output_line in iter(cmd_proc.stdout.readline, ""):
+      write_log(output_line)
+    cmd_proc.stdout.close()
+  cmd_return_code = cmd_proc.wait()
+  if step != None:
+    step.scheduler.untrack_process(cmd_proc)
+  timeline.record_exit_code(cmd_return_code)
   if  cmd_return_code != 0:
     print(err_mesg)
     InstallAbort()
   return 0
 
-def remove_images(install_args, blacklist):
-  cmd_proc = subprocess.Popen(["docker", "images"], stdout = subprocess.PIPE, universal_newlines=True)
-  installed_image = cmd_proc.stdout.readline()
-  while installed_image:
-    if installed_image[:18] == "parabricks/release":
-      installed_image_list = installed_image.split()
-      if installed_image_list[1] in blacklist:
-        installed_image = cmd_proc.stdout.readline()
+def parse_progress_size(size_value, size_unit):
+  size_unit = size_unit.upper()
+  unit_base = 1000
+  if "I" in size_unit:
+    unit_base = 1024
+  return int(float(size_value) * unit_base ** "BKMGT".index(size_unit[0]))
+
+def format_duration(seconds):
+  seconds = int(seconds)
+  return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+# Aggregates per-layer download progress from docker pull or singularity
+# build/pull output into total bytes, throughput and ETA.
+class PullProgress(object):
+  def __init__(self):
+    self.layers = {}
+    self.start_time = time.time()
+    self.sample_time = self.start_time
+    self.sample_bytes = 0
+    self.rate = 0.0
+    self.interactive = sys.stdout.isatty()
+    self.status_shown = False
+    self.last_display = self.last_log = self.start_time
+
+  # Returns True if the line only reports layer progress or status
+  def feed(self, output_line):
+    progress_match = DOCKER_LAYER_PROGRESS.search(output_line) or SINGULARITY_BLOB_PROGRESS.search(output_line)
+    if progress_match != None:
+      layer_id, current_value, current_unit, total_value, total_unit = progress_match.groups()
+      self.layers[layer_id[:12]] = [parse_progress_size(current_value, current_unit), parse_progress_size(total_value, total_unit)]
+      return True
+    status_match = DOCKER_LAYER_STATUS.search(output_line) or SINGULARITY_BLOB_STATUS.search(output_line)
+    if status_match != None:
+      layer_id = status_match.group(1)[:12]
+      if layer_id in self.layers and ("Download complete" in output_line or output_line.rstrip().endswith("done")):
+        self.layers[layer_id][0] = self.layers[layer_id][1]
+      return True
+    return False
+
+  # Docker Engine API pulls report progress as JSON messages instead of bars.
+  # Returns True for per-layer messages, which are only logged.
+  def feed_json(self, message):
+    layer_id = message.get("id", "")
+    if not re.match(r"^[0-9a-f]{12}$", layer_id):
+      return False
+    status = message.get("status", "")
+    progress_detail = message.get("progressDetail") or {}
+    if status == "Downloading" and progress_detail.get("total"):
+      self.layers[layer_id] = [progress_detail.get("current", 0), progress_detail["total"]]
+    elif status == "Download complete" and layer_id in self.layers:
+      self.layers[layer_id][0] = self.layers[layer_id][1]
+    if not progress_detail:
+      write_log(layer_id + ": " + status + "\n")
+    return True
+
+  def show_output(self, output_line):
+    write_log(output_line + "\n")
+    if self.status_shown == True:
+      sys.stdout.write("\r" + " " * 79 + "\r")
+      self.status_shown = False
+    print(output_line)
+
+  def update(self):
+    now = time.time()
+    if not self.layers:
+      return
+    if now - self.last_display >= 0.5:
+      self.sample()
+      self.last_display = now
+      if self.interactive == True:
+        sys.stdout.write("\r" + self.format_status().ljust(79))
+        sys.stdout.flush()
+        self.status_shown = True
+    if now - self.last_log >= PULL_LOG_SAMPLE_SECONDS:
+      self.last_log = now
+      write_log("pull throughput: %d of %d bytes, %.1f MB/s\n" % (self.downloaded(), self.total(), self.rate / 1e6))
+
+  def finish(self):
+    if self.status_shown == True:
+      sys.stdout.write("\n")
+      self.status_shown = False
+    if not self.layers:
+      return
+    print(self.format_summary())
+    write_log("pull throughput: " + self.format_summary() + "\n")
+    pull_phase = getattr(step_context, "phase", None)
+    if pull_phase != None:
+      pull_phase["downloaded_bytes"] = pull_phase.get("downloaded_bytes", 0) + self.downloaded()
+      pull_phase["average_bytes_per_second"] = self.average_rate()
+
+  def downloaded(self):
+    return sum(layer[0] for layer in self.layers.values())
+
+  def total(self):
+    return sum(layer[1] for layer in self.layers.values())
+
+  def sample(self):
+    now = time.time()
+    downloaded = self.downloaded()
+    if now > self.sample_time:
+      current_rate = (downloaded - self.sample_bytes) / (now - self.sample_time)
+      self.rate = current_rate if self.rate == 0.0 else 0.7 * self.rate + 0.3 * current_rate
+    self.sample_time = now
+    self.sample_bytes = downloaded
+    return downloaded
+
+  def format_status(self):
+    status = "Downloaded %.1f / %.1f MB  %.1f MB/s" % (self.downloaded() / 1e6, self.total() / 1e6, self.rate / 1e6)
+    if self.rate > 0 and self.total() > self.downloaded():
+      status += "  ETA " + format_duration((self.total() - self.downloaded()) / self.rate)
+    return status
+
+  def average_rate(self):
+    elapsed = time.time() - self.start_time
+    if elapsed <= 0:
+      return 0.0
+    return self.downloaded() / elapsed
+
+  def format_summary(self):
+    return "Downloaded %.1f MB in %.1f s (%.1f MB/s average)" % (self.downloaded() / 1e6, time.time() - self.start_time, self.average_rate() / 1e6)
+
+# Runs a docker pull / singularity build or pull on a pseudo terminal, so the
+# tools keep printing their progress bars, and shows aggregated throughput on
+# screen instead of the raw bars. Other output is shown as before, everything
+# goes to the log together with periodic throughput samples.
+def run_with_progress(cmd_line, err_mesg, environ=None, cwd=None):
+  step = getattr(step_context, "step", None)
+  write_log("+ " + " ".join(cmd_line) + "\n")
+  if pty != None:
+    master_fd, slave_fd = pty.openpty()
+    cmd_proc = subprocess.Popen(cmd_line, stdout = slave_fd, stderr = slave_fd, env=environ, cwd=cwd)
+    os.close(slave_fd)
+    output_fd = master_fd
+  else:
+    cmd_proc = subprocess.Popen(cmd_line, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env=environ, cwd=cwd)
+    output_fd = cmd_proc.stdout.fileno()
+  if step != None:
+    step.scheduler.track_process(cmd_proc)
+
+  progress = PullProgress()
+  pending_output = ""
+  while True:
+    try:
+      output_chunk = os.read(output_fd, 65536)
+    except OSError:
+      output_chunk = b""
+    if not output_chunk:
+      break
+    pending_output += ANSI_ESCAPE.sub("", output_chunk.decode("utf-8", "replace"))
+    output_lines = re.split(r"[\r\n]", pending_output)
+    pending_output = output_lines.pop()
+    for output_line in output_lines:
+      if not output_line.strip():
         continue
-      print("Removing older image: " + "parabricks/release:" + installed_image_list[1])
-      run_and_return(["docker", "rmi", "parabricks/release:" + installed_image_list[1]], "Could not uninstall all images")
-    installed_image = cmd_proc.stdout.readline()
-  print("\n")
+      if progress.feed(output_line) == False:
+        progress.show_output(output_line)
+      elif not DOCKER_LAYER_PROGRESS.search(output_line) and not SINGULARITY_BLOB_PROGRESS.search(output_line):
+        write_log(output_line + "\n")
+    progress.update()
+  if pty != None:
+    os.close(master_fd)
+  else:
+    cmd_proc.stdout.close()
 
-def uninstall_pbrun(install_args):
-  if install_args.container == "docker":
-    remove_images(install_args,[])
+  cmd_return_code = cmd_proc.wait()
+  if step != None:
+    step.scheduler.untrack_process(cmd_proc)
+  timeline.record_exit_code(cmd_return_code)
+  progress.finish()
+  if cmd_return_code != 0:
+    print(err_mesg)
+    InstallAbort()
+  return 0
 
-  install_folder = install_args.install_location + "/parabricks"
-  if os.path.exists(install_folder):
-    shutil.rmtree(install_folder)
+def run_and_capture(cmd_line, err_mesg, environ=None):
+  write_log("+ " + " ".join(cmd_line) + "\n")
+  cmd_proc = subprocess.Popen(cmd_line, stdout = subprocess.PIPE, stderr = log_file, universal_newlines=True, env=environ)
+  cmd_output = cmd_proc.communicate()[0]
+  if cmd_proc.returncode != 0:
+    print(err_mesg)
+    InstallAbort()
+  return cmd_output
 
-  try:
-    if os.path.lexists("/usr/bin/pbrun"):
-      os.unlink("/usr/bin/pbrun")
-  except OSError as exc:
-    print("Could not remove /usr/bin/pbrun. Permission denied")
+def format_size(size_bytes):
+  return "%.2f GB" % (size_bytes / 1e9)
 
-  print("Parabricks uninstalled from " + install_args.install_location)
+# Returns one {"ref", "tag", "id", "size", "tags"} entry per parabricks/release tag
+def list_installed_images():
+  def list_with_cli():
+    installed_images = []
+    cmd_proc = subprocess.Popen(["docker", "images", "--filter", "reference=parabricks/release", "--format", "{{json .}}"], stdout = subprocess.PIPE, stderr = log_file, universal_newlines=True)
+    for image_line in cmd_proc.stdout:
+      image_info = json.loads(image_line)
+      size_match = re.match(r"([\d.]+)\s*([kKMGT]?i?[bB])", image_info.get("Size", ""))
+      image_size = 0
+      if size_match != None:
+        image_size = parse_progress_size(size_match.group(1), size_match.group(2))
+      installed_images.append({"ref": image_info["Repository"] + ":" + image_info["Tag"], "tag": image_info["Tag"], "id": image_info["ID"], "size": image_size})
+    cmd_proc.wait()
+    # The filtered listing only shows parabricks tags, treat those as all tags of the image
+    for installed_image in installed_images:
+      installed_image["tags"] = [other["ref"] for other in installed_images if other["id"] == installed_image["id"]]
+    return installed_images
 
+  def list_with_engine(engine):
+    installed_images = []
+    for image_info in engine.list_images({"reference": ["parabricks/release"]}):
+      for repo_tag in image_info.get("RepoTags") or []:
+        if repo_tag.startswith("parabricks/release:"):
+          installed_images.append({"ref": repo_tag, "tag": repo_tag.split(":", 1)[1], "id": image_info["Id"], "size": image_info.get("Size", 0), "tags": image_info["RepoTags"]})
+    return installed_images
+  return call_docker(list_with_engine, list_with_cli)
 
-def check_curl():
-  print("Checking curl installation\n")
-  run_and_return ("command -v curl", "curl --version failed. Please check installation of curl.", True)
+# Space is only reclaimed once every tag of an image is removed
+def get_reclaimed_size(removed_images):
+  removed_refs = set(removed_image["ref"] for removed_image in removed_images)
+  reclaimed = {}
+  for removed_image in removed_images:
+    if set(removed_image["tags"]) <= removed_refs:
+      reclaimed[removed_image["id"]] = removed_image["size"]
+  return sum(reclaimed.values())
 
-def check_nvidia_docker(archImage):
-  cmd_return_code = subprocess.call("command -v "+NVIDIA_DOCKER, stdout = log_file, stderr = log_file, shell=True)
-  if  cmd_return_code != 0:
-    return False
-  cmd_return_code = subprocess.call([NVIDIA_DOCKER, "run", "--rm", "--gpus", "all", "nvidia/cuda" + archImage + ":9.0-base-ubuntu16.04", "nvidia-smi"] , stdout = log_file, stderr = log_file)
-  if  cmd_return_code != 0:
-    return False
+def remove_images(install_args, blacklist):
+  keep_list = set(blacklist)
+  installed_images = list_installed_images()
+  remove_image_entries(install_args, [installed_image for installed_image in installed_images if installed_image["tag"] not in keep_list and installed_image["ref"] not in keep_list])
+
+def remove_image_entries(install_args, removed_images):
+  if not removed_images:
+    return
+  for removed_image in removed_images:
+    if install_args.dry_run == True:
+      print("Would remove image: " + removed_image["ref"] + " (" + format_size(removed_image["size"]) + ")")
+    else:
+      print("Removing older image: " + removed_image["ref"])
+  if install_args.dry_run == True:
+    print("Would reclaim about " + format_size(get_reclaimed_size(removed_images)) + " from " + str(len(removed_images)) + " images\n")
+    return
+
+  removed_refs = [removed_image["ref"] for removed_image in removed_images]
+  def remove_with_engine(engine):
+    def remove_one(image_ref):
+      try:
+        engine.remove_image(image_ref)
+        return None
+      except DockerEngineError as exc:
+        return str(exc)
+    failures = [failure for failure in run_parallel(remove_one, removed_refs, 4) if failure != None]
+    for failure in failures:
+      write_log(failure + "\n")
+    if failures:
+      print("Could not uninstall all images")
+      InstallAbort()
+  call_docker(remove_with_engine, lambda: run_and_return(["docker", "rmi"] + removed_refs, "Could not uninstall all images"))
+  print("Reclaimed about " + format_size(get_reclaimed_size(removed_images)) + "\n")
+
+# Removes what the inventory says was installed. Without an inventory (installs
+# made by older installers) falls back to removing every parabricks image and
+# the default install folder.
+def uninstall_pbrun(install_args):
+  inventory = load_inventory(install_args.install_root)
+  install_records = [inventory["releases"][install_key] for install_key in sorted(inventory["releases"])]
+  if install_records:
+    print("Uninstalling releases recorded in " + inventory_path(install_args.install_root) + ": " + ", ".join(install_record["release"] + " (" + install_record["container"] + ")" for install_record in install_records) + "\n")
+    recorded_refs = set(install_record["image"]["ref"] for install_record in install_records if install_record["container"] == "docker")
+    if recorded_refs:
+      remove_image_entries(install_args, [installed_image for installed_image in list_installed_images() if installed_image["ref"] in recorded_refs])
+    removed_folders = [install_record["install_folder"] for install_record in install_records]
+    removed_links = [install_record["symlink"] for install_record in install_records if install_record["symlink"] != None]
   else:
-    return True
+    if install_args.container == "docker":
+      remove_images(install_args,[])
+    removed_folders = [install_args.install_root + "/parabricks"]
+    removed_links = ["/usr/bin/pbrun"]
+  removed_folders = sorted(set(folder for folder in removed_folders if os.path.exists(folder)))
+  removed_links = sorted(set(link for link in removed_links if os.path.lexists(link)))
+
+  if install_args.dry_run == True:
+    for removed_path in removed_folders + removed_links:
+      print("Would remove " + removed_path)
+    return
+
+  for folder in removed_folders:
+    shutil.rmtree(folder)
+
+  for link in removed_links:
+    try:
+      os.unlink(link)
+    except OSError as exc:
+      print("Could not remove " + link + ". Permission denied")
+
+  if install_records:
+    with locked_file(inventory_path(install_args.install_root) + ".lock"):
+      remove_file(inventory_path(install_args.install_root))
+    remove_file(inventory_path(install_args.install_root) + ".lock")
+  print("Parabricks uninstalled from " + install_args.install_root)
+
+
+def run_parallel(func, items, max_workers=8):
+  results = [None] * len(items)
+  errors = []
+  pending = list(enumerate(items))
+  pending_lock = threading.Lock()
+
+  def worker():
+    while True:
+      with pending_lock:
+        if not pending:
+          return
+        index, item = pending.pop(0)
+      try:
+        results[index] = func(item)
+      except Exception as exc:
+        errors.append(exc)
 
-def check_docker(cpu_only):
+  workers = [threading.Thread(target=worker) for i in range(min(max_workers, len(items)))]
+  for worker_thread in workers:
+    worker_thread.daemon = True
+    worker_thread.start()
+  for worker_thread in workers:
+    worker_thread.join()
+  if errors:
+    raise errors[0]
+  return results
+
+def probe_command(cmd_line):
+  try:
+    cmd_proc = subprocess.Popen(cmd_line, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, universal_newlines=True)
+  except OSError as exc:
+    return {"returncode": 127, "output": str(exc) + "\n"}
+  output = cmd_proc.communicate()[0]
+  return {"returncode": cmd_proc.returncode, "output": output}
+
+# Each probe is (binary, command). A probe without a command only checks that the binary exists.
+# CPU only installs use plain docker either way, so they skip the GPU container probe,
+# which fails (and is not cached) on every run on nodes without working GPU docker.
+def get_preflight_probes(container, cpu_only):
   archImage = ""
   if install_args.arch == "ppc64le":
     archImage = "-ppc64le"
 
-  if check_nvidia_docker(archImage) == True:
+  probes = {"curl": ("curl", None)}
+  if container == "singularity":
+    probes["singularity"] = ("singularity", ["singularity", "--version"])
+  else:
+    if not cpu_only:
+      probes["nvidia_docker"] = (NVIDIA_DOCKER, [NVIDIA_DOCKER, "run", "--rm", "--gpus", "all", "nvidia/cuda" + archImage + ":9.0-base-ubuntu16.04", "nvidia-smi"])
+    probes["docker"] = ("docker", None)
+  return probes
+
+def get_probe_key(binary_path, cmd_line):
+  if binary_path == None:
+    return None
+  try:
+    binary_mtime = os.stat(binary_path).st_mtime
+  except OSError:
+    return None
+  return {"path": binary_path, "mtime": binary_mtime, "arch": install_args.arch, "cmd": cmd_line}
+
+def run_preflight_probe(probe):
+  binary_path, cmd_line = probe
+  if binary_path == None:
+    return {"returncode": 127, "output": "not found\n"}
+  if cmd_line == None:
+    return {"returncode": 0, "output": binary_path + "\n"}
+  return probe_command(cmd_line)
+
+# Temporary files next to shared files (e.g. on NFS) must not collide with those
+# of a process with the same pid on another node
+def get_tmp_suffix():
+  return ".tmp." + socket.gethostname() + "." + str(os.getpid())
+
+def write_json_atomic(json_path, data):
+  tmp_path = json_path + get_tmp_suffix()
+  with open(tmp_path, "w") as json_file:
+    json.dump(data, json_file, indent=2, sort_keys=True)
+  os.rename(tmp_path, json_path)
+
+@contextlib.contextmanager
+def locked_file(lock_path, waiting_message=None):
+  with open(lock_path, "a") as lock_file:
+    try:
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as exc:
+      if exc.errno not in (errno.EAGAIN, errno.EACCES):
+        raise
+      if waiting_message != None:
+        print(waiting_message)
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    try:
+      yield lock_file
+    finally:
+      fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def load_preflight_cache():
+  try:
+    with open(PREFLIGHT_CACHE_FILE, "r") as cache_file:
+      return json.load(cache_file)
+  except (IOError, OSError, ValueError):
+    return {}
+
+def save_preflight_cache(cache):
+  try:
+    if not os.path.isdir(os.path.dirname(PREFLIGHT_CACHE_FILE)):
+      os.makedirs(os.path.dirname(PREFLIGHT_CACHE_FILE))
+    write_json_atomic(PREFLIGHT_CACHE_FILE, cache)
+  except (IOError, OSError):
+    write_log("Could not write preflight cache " + PREFLIGHT_CACHE_FILE + "\n")
+
+# Runs all probes at once. Only successful results are cached, so a failed probe
+# (e.g. a GPU driver that was not loaded yet) is retried on the next run.
+def run_preflight(probes, use_cache):
+  cache = {}
+  if use_cache == True:
+    cache = load_preflight_cache()
+  results = {}
+  pending = []
+  for probe_name in sorted(probes):
+    binary, cmd_line = probes[probe_name]
+    binary_path = find_executable(binary)
+    probe_key = get_probe_key(binary_path, cmd_line)
+    cached = cache.get(probe_name)
+    if probe_key != None and cached != None and cached.get("key") == probe_key:
+      write_log("+ preflight " + probe_name + " (cached)\n")
+      results[probe_name] = cached["result"]
+    else:
+      pending.append((probe_name, binary_path, cmd_line, probe_key))
+
+  outputs = run_parallel(lambda entry: run_preflight_probe((entry[1], entry[2])), pending)
+  for entry, result in zip(pending, outputs):
+    probe_name, probe_key = entry[0], entry[3]
+    if entry[2] != None:
+      write_log("+ " + " ".join(entry[2]) + "\n")
+    else:
+      write_log("+ command -v " + probes[probe_name][0] + "\n")
+    write_log(result["output"])
+    results[probe_name] = result
+    if result["returncode"] == 0 and probe_key != None:
+      cache[probe_name] = {"key": probe_key, "result": result}
+    else:
+      cache.pop(probe_name, None)
+
+  if use_cache == True and pending:
+    save_preflight_cache(cache)
+  return results
+
+def check_curl(preflight):
+  print("Checking curl installation\n")
+  if preflight["curl"]["returncode"] != 0:
+    print("curl --version failed. Please check installation of curl.")
+    InstallAbort()
+
+def check_nvidia_docker(preflight):
+  return "nvidia_docker" in preflight and preflight["nvidia_docker"]["returncode"] == 0
+
+def check_docker(cpu_only, preflight):
+  if check_nvidia_docker(preflight) == True:
     return NVIDIA_DOCKER
 
   print("Checking docker installation\n")
-  run_and_return("command -v docker", "docker not found. Please check installation of docker.", True)
+  if preflight["docker"]["returncode"] != 0:
+    print("docker not found. Please check installation of docker.")
+    InstallAbort()
   if cpu_only:
     return "docker"
   else:
     print(textwrap.fill("Error in docker installation. Check install log in tmp folder", 120))
 
-def check_singularity():
+def check_singularity(preflight):
   print("Checking singularity installation\n")
-  run_and_return("command -v singularity", "singularity not found. Please check singularity installation", True)
-  run_and_return(["singularity", "--version"], "singularity --version failed. Please check installation of singularity.")
-  cmd_proc = subprocess.Popen(["singularity", "--version"], stdout = subprocess.PIPE, universal_newlines=True)
-  singularity_version = cmd_proc.stdout.readline().split('.')
+  if find_executable("singularity") == None:
+    print("singularity not found. Please check singularity installation")
+    InstallAbort()
+  if preflight["singularity"]["returncode"] != 0:
+    print("singularity --version failed. Please check installation of singularity.")
+    InstallAbort()
+  singularity_version = (preflight["singularity"]["output"].splitlines() or [""])[0].split(".")
   if "singularity version " in singularity_version[0]:
     if os.getuid() != 0:
       print(textwrap.fill("You need root permissions to install with singularity v3.x or higher. Try with sudo, or install on a machine with sudo and copy the parabricks folder, or contact system administrator", 120))
@@ -166,31 +745,274 @@ def check_singularity():
 
 def check_requirements(cpu_only):
   runCmd = ""
-  check_curl()
-  if install_args.container == "singularity":
-    runCmd = check_singularity()
-  else:
-    runCmd = check_docker(cpu_only)
+  with timeline.phase("preflight"):
+    print("Running preflight checks\n")
+    preflight = run_preflight(get_preflight_probes(install_args.container, cpu_only), install_args.preflight_cache)
+    check_curl(preflight)
+    if install_args.container == "singularity":
+      runCmd = check_singularity(preflight)
+    else:
+      runCmd = check_docker(cpu_only, preflight)
   return runCmd
 
-def check_image_pre_install():
-  print("Checking if image is already present\n")
-  release_full_name = "registry.gitlab.com/pbuser/release/" + install_args.arch + ":" + install_args.release
-  if install_args.ngc == True:
-    release_full_name = "nvcr.io/hpc/parabricks:" + install_args.release
+class UnixHTTPConnection(httplib.HTTPConnection):
+  def __init__(self, socket_path, timeout=None):
+    httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+    self.socket_path = socket_path
 
-  cmd_return_code = subprocess.call(["docker", "inspect", "--type=image", release_full_name], stdout = log_file, stderr = log_file)
-  if  cmd_return_code == 0:
-    print("Docker image already present, please remove the docker image: " + release_full_name + " and then try re-installation")
-    print("\nRun\ndocker rmi " + release_full_name + "\nto remove the image. Make sure you really want to do this.")
-    InstallAbort()
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if self.timeout != None:
+      self.sock.settimeout(self.timeout)
+    self.sock.connect(self.socket_path)
 
-  cmd_return_code = subprocess.call(["docker", "inspect", "--type=image", "parabricks/release:" + install_args.release], stdout = log_file, stderr = log_file)
-  if  cmd_return_code == 0:
-    print("Docker image already present, please remove the docker image: parabricks/release: " + install_args.release  + " and then try re-installation")
-    print("\nRun\ndocker rmi parabricks/release:" + install_args.release + "\nto remove the image. Make sure you really want to do this.")
-    InstallAbort()
+class DockerEngineError(Exception):
+  def __init__(self, status, message):
+    Exception.__init__(self, "Docker Engine API error " + str(status) + ": " + message)
+    self.status = status
+
+def split_image_ref(image_ref):
+  repository, separator, tag = image_ref.rpartition(":")
+  if separator == "" or "/" in tag:
+    return image_ref, "latest"
+  return repository, tag
+
+# Talks to the Docker Engine HTTP API over its unix socket. Idle keep-alive
+# connections are pooled and reused, so a whole install runs over a handful of
+# connections instead of forking one docker CLI process per operation.
+class DockerEngineClient(object):
+  def __init__(self, socket_path, max_idle=4):
+    self.socket_path = socket_path
+    self.max_idle = max_idle
+    self.idle_connections = []
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    with self.lock:
+      if self.idle_connections:
+        return self.idle_connections.pop()
+    return UnixHTTPConnection(self.socket_path)
+
+  def release(self, connection, response):
+    if response.will_close:
+      connection.close()
+      return
+    with self.lock:
+      if len(self.idle_connections) < self.max_idle:
+        self.idle_connections.append(connection)
+        return
+    connection.close()
+
+  def close(self):
+    with self.lock:
+      for connection in self.idle_connections:
+        connection.close()
+      self.idle_connections = []
+
+  # Returns (connection, response). A pooled connection the daemon has closed in
+  # the meantime is retried once on a fresh one.
+  def request(self, method, path, params=None, body=None, headers=None):
+    url = quote(path, safe="/:@")
+    if params:
+      url += "?" + urlencode(params)
+    request_headers = {"Content-Type": "application/json"}
+    request_headers.update(headers or {})
+    if body != None:
+      body = json.dumps(body)
+    write_log("+ docker engine " + method + " " + url + "\n")
+    for attempt in range(2):
+      connection = self.acquire()
+      try:
+        connection.request(method, url, body, request_headers)
+        return connection, connection.getresponse()
+      except (httplib.HTTPException, socket.error):
+        connection.close()
+        if attempt == 1:
+          raise
+
+  def check_response(self, connection, response):
+    if response.status < 400:
+      return
+    error_body = response.read()
+    self.release(connection, response)
+    try:
+      message = json.loads(error_body.decode("utf-8")).get("message", "")
+    except ValueError:
+      message = error_body.decode("utf-8", "replace")
+    raise DockerEngineError(response.status, message)
+
+  def call(self, method, path, params=None, body=None, headers=None):
+    connection, response = self.request(method, path, params, body, headers)
+    self.check_response(connection, response)
+    response_body = response.read()
+    self.release(connection, response)
+    if not response_body or response.getheader("Content-Type", "").find("json") < 0:
+      return response_body.decode("utf-8", "replace")
+    return json.loads(response_body.decode("utf-8"))
+
+  def ping(self):
+    return self.call("GET", "/_ping") == "OK"
+
+  def inspect_image(self, image_ref):
+    try:
+      return self.call("GET", "/images/" + image_ref + "/json")
+    except DockerEngineError as exc:
+      if exc.status == 404:
+        return None
+      raise
+
+  def list_images(self, filters=None):
+    params = None
+    if filters != None:
+      params = {"filters": json.dumps(filters)}
+    return self.call("GET", "/images/json", params)
+
+  def tag_image(self, image_ref, target_ref):
+    repository, tag = split_image_ref(target_ref)
+    self.call("POST", "/images/" + image_ref + "/tag", {"repo": repository, "tag": tag})
+
+  def remove_image(self, image_ref, force=False):
+    return self.call("DELETE", "/images/" + image_ref, {"force": str(force).lower()})
+
+  def pull_image(self, image_ref, auth_config=None, progress=None):
+    repository, tag = split_image_ref(image_ref)
+    headers = {}
+    if auth_config != None:
+      headers["X-Registry-Auth"] = base64.urlsafe_b64encode(json.dumps(auth_config).encode("utf-8")).decode("ascii")
+    connection, response = self.request("POST", "/images/create", {"fromImage": repository, "tag": tag}, headers=headers)
+    self.check_response(connection, response)
+    for message_line in response:
+      if not message_line.strip():
+        continue
+      message = json.loads(message_line.decode("utf-8"))
+      if "error" in message:
+        connection.close()
+        raise DockerEngineError(500, message["error"])
+      if progress != None:
+        if progress.feed_json(message) == False and message.get("status"):
+          progress.show_output(message["status"])
+        progress.update()
+    self.release(connection, response)
+
+  def create_container(self, image_ref, cmd):
+    return self.call("POST", "/containers/create", body={"Image": image_ref, "Cmd": cmd})["Id"]
+
+  # Returns a response streaming a tar archive of path, like docker cp <id>:<path> -
+  def get_archive(self, container_id, path):
+    connection, response = self.request("GET", "/containers/" + container_id + "/archive", {"path": path})
+    self.check_response(connection, response)
+    return connection, response
+
+  def remove_container(self, container_id):
+    self.call("DELETE", "/containers/" + container_id, {"force": "true"})
+
+# Returns a DockerEngineClient, or None when the docker CLI should be used
+def get_docker_engine():
+  global docker_engine
+  if docker_engine == False:
+    docker_engine = None
+    socket_path = DOCKER_SOCKET
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if docker_host.startswith("unix://"):
+      socket_path = docker_host[len("unix://"):]
+    if install_args.docker_cli == False and (docker_host == "" or docker_host.startswith("unix://")) and os.path.exists(socket_path):
+      engine = DockerEngineClient(socket_path)
+      try:
+        if engine.ping() == True:
+          docker_engine = engine
+      except (DockerEngineError, httplib.HTTPException, socket.error) as exc:
+        write_log("Docker Engine API not usable (" + str(exc) + "), using the docker CLI\n")
+  return docker_engine
+
+# Runs engine_call against the Docker Engine API when it is available, and
+# cli_call otherwise. Losing the socket mid-install falls back to the CLI.
+def call_docker(engine_call, cli_call):
+  global docker_engine
+  engine = get_docker_engine()
+  if engine != None:
+    try:
+      return engine_call(engine)
+    except (httplib.HTTPException, socket.error) as exc:
+      write_log("Docker Engine API connection failed (" + str(exc) + "), using the docker CLI\n")
+      docker_engine = None
+  return cli_call()
+
+def engine_or_abort(engine_call, err_mesg):
+  def checked_call(engine):
+    try:
+      return engine_call(engine)
+    except DockerEngineError as exc:
+      write_log(str(exc) + "\n")
+      timeline.record_exit_code(1)
+      print(err_mesg)
+      InstallAbort()
+  return checked_call
+
+def docker_inspect_image(image_ref):
+  def inspect_with_cli():
+    cmd_proc = subprocess.Popen(["docker", "inspect", "--type=image", image_ref], stdout = subprocess.PIPE, stderr = log_file, universal_newlines=True)
+    inspect_output = cmd_proc.communicate()[0]
+    if cmd_proc.returncode != 0:
+      return None
+    return json.loads(inspect_output)[0]
+  return call_docker(lambda engine: engine.inspect_image(image_ref), inspect_with_cli)
+
+def docker_tag_image(image_ref, target_ref, err_mesg):
+  call_docker(engine_or_abort(lambda engine: engine.tag_image(image_ref, target_ref), err_mesg),
+              lambda: run_and_return(["docker", "tag", image_ref, target_ref], err_mesg))
 
+def docker_remove_image(image_ref, err_mesg):
+  call_docker(engine_or_abort(lambda engine: engine.remove_image(image_ref), err_mesg),
+              lambda: run_and_return(["docker", "rmi", image_ref], err_mesg))
+
+def docker_pull_image(image_ref, err_mesg):
+  def pull_with_engine(engine):
+    auth_config = None
+    if install_args.ngc == False:
+      auth_config = {"username": "pbuser", "password": install_args.access_token, "serveraddress": "registry.gitlab.com"}
+    progress = PullProgress()
+    try:
+      engine.pull_image(image_ref, auth_config, progress)
+    finally:
+      progress.finish()
+
+  def pull_with_cli():
+    if install_args.ngc == True:
+      run_with_progress(["docker", "pull", image_ref], err_mesg)
+    else:
+      run_and_return(["docker", "login", "registry.gitlab.com", "-u", "pbuser", "-p", install_args.access_token], "Cannot contact Parabricks registry.")
+      run_with_progress(["docker", "pull", image_ref], err_mesg)
+      run_and_return(["docker", "logout", "registry.gitlab.com"], "Error logging out of Parabricks registry.")
+  call_docker(engine_or_abort(pull_with_engine, err_mesg), pull_with_cli)
+
+def get_release_full_name():
+  if install_args.ngc == True:
+    return "nvcr.io/hpc/parabricks:" + install_args.release
+  return "registry.gitlab.com/pbuser/release/" + install_args.arch + ":" + install_args.release
+
+# Returns the reference of an image already present that has a digest recorded
+# for this release (e.g. left by an earlier --image-cache install), None if
+# there is none. Any other image of this release stops the installation.
+def check_image_pre_install():
+  print("Checking if image is already present\n")
+  release_full_name = get_release_full_name()
+  expected_digests = get_expected_docker_digests(release_full_name)
+
+  reused_ref = None
+  for image_ref in [release_full_name, "parabricks/release:" + install_args.release]:
+    image_id = get_docker_image_id(image_ref)
+    if image_id == None:
+      continue
+    if image_id not in expected_digests:
+      print("Docker image already present, please remove the docker image: " + image_ref + " and then try re-installation")
+      print("\nRun\ndocker rmi " + image_ref + "\nto remove the image. Make sure you really want to do this.")
+      InstallAbort()
+    if reused_ref == None:
+      print("Docker image " + image_ref + " already present matches " + expected_digests[image_id] + ", reusing it\n")
+      expected_image["digest"] = image_id
+      expected_image["source"] = expected_digests[image_id]
+      reused_ref = image_ref
+  return reused_ref
 
 def print_selection(allArgs):
   print("====================================")
@@ -220,16 +1042,38 @@ def get_install_args():
   parser.add_argument("--container", help=argparse.SUPPRESS, default="docker", choices=["docker", "singularity"])
   parser.add_argument("--access-token", help=argparse.SUPPRESS, default="ma-n1NazFEnDDwpoc-a2")
   parser.add_argument("--uninstall", help="Remove all parabricks installations", action='store_true', default=False)
+  parser.add_argument("--upgrade", help="Upgrade an existing installation in place, only writing scripts that changed. The upgraded folder is swapped in atomically where the file system supports it, otherwise with two renames", action='store_true', default=False)
+  parser.add_argument("--shared", help="The install location is shared between nodes (e.g. on NFS), one node builds the installation while the others wait and only activate it", action='store_true', default=False)
+  parser.add_argument("--verify", help="Check the recorded installations against their image digests and script hashes and exit", action='store_true', default=False)
+  parser.add_argument("--deep-verify", help="Also run pbrun version when verifying, which starts a container", action='store_true', default=False)
+  parser.add_argument("--status", help="Show the parabricks installations recorded in the install location and exit", action='store_true', default=False)
+  parser.add_argument("--dry-run", help="With --uninstall, only show what would be removed and how much space it frees", action='store_true', default=False)
   parser.add_argument("--symlink", help="Create symlink for /usr/bin/pbrun", action='store_true', default=False)
   parser.add_argument("--force", help="Disable interactive installation", action='store_true', default=False)
   parser.add_argument("--ngc", help="Pull image from NGC", action='store_false', default=True)
   parser.add_argument("--cpu-only", help="Install CPU only accelerated tools", action='store_true', default=False)
+  parser.add_argument("--image-cache", help="Directory of a (possibly shared) local image cache to install from and store pulled images in", default=None)
+  parser.add_argument("--image-cache-size", help="Maximum size of the image cache in GB, least recently used images are evicted first", type=float, default=200)
+  parser.add_argument("--prefetch", help="Start downloading the image while the installation prompts are answered", action='store_true', default=False)
+  parser.add_argument("--critical-path", help="Print the chain of installation steps that determined the install time", action='store_true', default=False)
+  parser.add_argument("--chrome-trace", help="Also write the install timeline in Chrome trace format", action='store_true', default=False)
+  parser.add_argument("--docker-cli", help="Use the docker command line tool instead of the Docker Engine API socket", action='store_true', default=False)
+  parser.add_argument("--fleet", help="Install on every host listed in this file (one per line) with installer.py --force, {host} in other options is replaced with the host name", default=None)
+  parser.add_argument("--fleet-workers", help="Number of hosts installed at the same time in fleet mode", type=int, default=8)
+  parser.add_argument("--fleet-transport", help="How the installer is started on fleet hosts, ssh expects it at the same path on every host", default="ssh", choices=["ssh", "local"])
+  parser.add_argument("--fleet-retries", help="Number of times a failed host install is retried in fleet mode", type=int, default=1)
+  parser.add_argument("--fleet-timeout", help="Seconds after which a host install is stopped in fleet mode", type=float, default=None)
+  parser.add_argument("--fleet-node", help=argparse.SUPPRESS, action='store_true', default=False)
+  parser.add_argument("--no-preflight-cache", dest="preflight_cache", help="Re-run all installation checks instead of reusing results from " + PREFLIGHT_CACHE_FILE, action='store_false', default=True)
   allArgs = parser.parse_args()
+  allArgs.install_root = GetFullDirPath(allArgs.install_location)
+  if allArgs.status == True or allArgs.verify == True:
+    return allArgs
   if allArgs.uninstall == True:
     print("Starting Uninstallation\n")
     return allArgs
 
-  allArgs.install_location = GetFullDirPath(allArgs.install_location) + "/parabricks"
+  allArgs.install_location = allArgs.install_root + "/parabricks"
   cmd_proc = subprocess.Popen(["uname", "-m"], stdout = subprocess.PIPE, universal_newlines=True)
   if allArgs.arch == None:
     sys_arch = cmd_proc.stdout.readline().rstrip('\n')
@@ -259,55 +1103,484 @@ def check_install_folder(install_folder):
     print("\nPlease check you have write permissions in " + install_folder)
     InstallAbort()
 
+def hash_file(file_path):
+  file_hash = hashlib.sha256()
+  with open(file_path, "rb") as hashed_file:
+    chunk = hashed_file.read(1048576)
+    while chunk:
+      file_hash.update(chunk)
+      chunk = hashed_file.read(1048576)
+  return "sha256:" + file_hash.hexdigest()
+
+def link_or_copy(src_path, dst_path):
+  try:
+    os.link(src_path, dst_path)
+  except OSError:
+    shutil.copyfile(src_path, dst_path)
+
+# The image cache stores images by digest under <cache>/blobs. index.json maps
+# "<digest>/<format>" to the blob, the registry references it was pulled as,
+# its size and when it was last used (for LRU eviction).
+def image_cache_index_path():
+  return install_args.image_cache + "/index.json"
+
+def load_image_cache_index():
+  try:
+    with open(image_cache_index_path(), "r") as index_file:
+      return json.load(index_file)
+  except (IOError, OSError, ValueError):
+    return {"entries": {}}
+
+def image_cache_lookup(image_ref, formats):
+  if install_args.image_cache == None:
+    return None
+  with locked_file(install_args.image_cache + "/index.lock"):
+    cache_index = load_image_cache_index()
+    for image_format in formats:
+      for entry_key, entry in sorted(cache_index["entries"].items()):
+        blob_path = install_args.image_cache + "/" + entry["file"]
+        if entry["format"] != image_format or image_ref not in entry["refs"]:
+          continue
+        if not os.path.isfile(blob_path) or os.path.getsize(blob_path) != entry["size"]:
+          continue
+        entry["last_used"] = time.time()
+        write_json_atomic(image_cache_index_path(), cache_index)
+        found = dict(entry)
+        found["path"] = blob_path
+        return found
+  return None
+
+def image_cache_evict(cache_index, keep_key):
+  size_limit = int(install_args.image_cache_size * 1024 * 1024 * 1024)
+  total_size = sum(entry["size"] for entry in cache_index["entries"].values())
+  for entry_key, entry in sorted(cache_index["entries"].items(), key=lambda item: item[1]["last_used"]):
+    if total_size <= size_limit:
+      break
+    if entry_key == keep_key:
+      continue
+    print("Evicting " + entry["digest"] + " (" + ", ".join(entry["refs"]) + ") from image cache")
+    try:
+      os.remove(install_args.image_cache + "/" + entry["file"])
+    except OSError:
+      pass
+    total_size -= entry["size"]
+    del cache_index["entries"][entry_key]
+
+def image_cache_remove(entry):
+  with locked_file(install_args.image_cache + "/index.lock"):
+    cache_index = load_image_cache_index()
+    cache_index["entries"].pop(entry["digest"] + "/" + entry["format"], None)
+    write_json_atomic(image_cache_index_path(), cache_index)
+  try:
+    os.remove(entry["path"])
+  except OSError:
+    pass
+
+# Moves (or links) image_path into the cache under its digest. Without an
+# image_path only the reference is added to a blob the cache already has.
+# Returns False if the cache is disabled or the image could not be stored.
+def image_cache_store(image_ref, digest, image_format, image_path, move_file):
+  if install_args.image_cache == None:
+    return False
+  extension = {"docker-archive": ".tar", "sif": ".sif", "simg": ".simg"}[image_format]
+  blob_file = "blobs/" + digest.replace(":", "-") + extension
+  blob_path = install_args.image_cache + "/" + blob_file
+  entry_key = digest + "/" + image_format
+  try:
+    with locked_file(install_args.image_cache + "/index.lock"):
+      cache_index = load_image_cache_index()
+      if image_path == None and not os.path.isfile(blob_path):
+        return False
+      if not os.path.isfile(blob_path):
+        if move_file == True:
+          os.rename(image_path, blob_path)
+        else:
+          link_or_copy(image_path, blob_path + get_tmp_suffix())
+          os.rename(blob_path + get_tmp_suffix(), blob_path)
+      elif move_file == True and image_path != None:
+        os.remove(image_path)
+      entry = cache_index["entries"].get(entry_key, {"refs": []})
+      entry.update({"digest": digest, "format": image_format, "file": blob_file, "size": os.path.getsize(blob_path), "last_used": time.time()})
+      if image_ref not in entry["refs"]:
+        entry["refs"].append(image_ref)
+      cache_index["entries"][entry_key] = entry
+      image_cache_evict(cache_index, entry_key)
+      write_json_atomic(image_cache_index_path(), cache_index)
+  except (IOError, OSError) as exc:
+    write_log("Could not store " + image_ref + " in image cache: " + str(exc) + "\n")
+    return False
+  print("Stored " + image_ref + " in image cache as " + digest + "\n")
+  return True
+
+def check_image_cache():
+  if install_args.image_cache == None:
+    return
+  install_args.image_cache = GetFullDirPath(install_args.image_cache)
+  try:
+    if not os.path.isdir(install_args.image_cache + "/blobs"):
+      os.makedirs(install_args.image_cache + "/blobs")
+  except OSError:
+    print("\nPlease check you have permissions to create the image cache in " + install_args.image_cache)
+    InstallAbort()
+
+def get_docker_image_id(image_ref):
+  image_info = docker_inspect_image(image_ref)
+  if image_info == None:
+    return None
+  return image_info["Id"]
+
+def get_docker_image_size(image_ref):
+  image_info = docker_inspect_image(image_ref)
+  if image_info == None:
+    return 0
+  return image_info.get("Size", 0)
+
+def load_docker_image_from_cache(release_full_name):
+  cached_image = image_cache_lookup(release_full_name, ["docker-archive"])
+  if cached_image == None:
+    return False
+  print("\nLoading image " + cached_image["digest"] + " from cache\n")
+  write_log("+ docker load -i " + cached_image["path"] + "\n")
+  cmd_return_code = subprocess.call(["docker", "load", "-i", cached_image["path"]], stdout = log_file, stderr = log_file)
+  if cmd_return_code == 0 and get_docker_image_id(release_full_name) == cached_image["digest"]:
+    expected_image["digest"] = cached_image["digest"]
+    expected_image["source"] = "the image cache"
+    return True
+  print("Cached image does not match " + release_full_name + ", downloading it instead\n")
+  image_cache_remove(cached_image)
+  return False
+
+def store_docker_image_in_cache(release_full_name):
+  if install_args.image_cache == None:
+    return
+  image_id = get_docker_image_id(release_full_name)
+  if image_id == None:
+    return
+  # Skip docker save if another node or an earlier install stored this image
+  if image_cache_store(release_full_name, image_id, "docker-archive", None, True) == True:
+    return
+  archive_path = install_args.image_cache + "/blobs/" + image_id.replace(":", "-") + ".tar" + get_tmp_suffix()
+  print("Saving image to cache\n")
+  write_log("+ docker save -o " + archive_path + " " + release_full_name + "\n")
+  if subprocess.call(["docker", "save", "-o", archive_path, release_full_name], stdout = log_file, stderr = log_file) != 0:
+    print("Could not save image to cache, continuing without it\n")
+    if os.path.exists(archive_path):
+      os.remove(archive_path)
+    return
+  if image_cache_store(release_full_name, image_id, "docker-archive", archive_path, True) == False and os.path.exists(archive_path):
+    os.remove(archive_path)
+
+def store_singularity_image_in_cache(release_full_name, image_format, image_path):
+  if install_args.image_cache == None:
+    return
+  print("Saving image to cache\n")
+  image_cache_store(release_full_name, hash_file(image_path), image_format, image_path, False)
+
+# Downloads the image in the background while the user is still answering the
+# EULA and selection prompts. The install either commits the download or, if the
+# user declines or the install aborts, cancels it and removes what was fetched.
+class ImagePrefetch(object):
+  def __init__(self, cmd_lines, image_ref=None, prefetch_dir=None, environ=None):
+    self.cmd_lines = cmd_lines
+    self.image_ref = image_ref
+    self.prefetch_dir = prefetch_dir
+    self.environ = environ
+    self.proc = None
+    self.lock = threading.Lock()
+    self.cancelled = False
+    self.committed = False
+    self.succeeded = False
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+
+  def run(self):
+    for cmd_line in self.cmd_lines:
+      with self.lock:
+        if self.cancelled == True:
+          return
+        write_log("+ (background) " + " ".join(cmd_line) + "\n")
+        self.proc = subprocess.Popen(cmd_line, stdout = log_file, stderr = log_file, env=self.environ)
+      if self.proc.wait() != 0:
+        return
+    self.succeeded = True
+
+  def commit(self):
+    if self.thread.is_alive():
+      print("\nWaiting for background image download to finish\n")
+    self.thread.join()
+    self.committed = True
+    if self.succeeded == False and self.prefetch_dir != None:
+      shutil.rmtree(self.prefetch_dir, True)
+    return self.succeeded
+
+  def cancel(self):
+    with self.lock:
+      if self.committed == True or self.cancelled == True:
+        return
+      self.cancelled = True
+      if self.proc != None and self.proc.poll() == None:
+        self.proc.terminate()
+    self.thread.join()
+    with open(os.devnull, "w") as devnull:
+      if self.image_ref != None and subprocess.call(["docker", "inspect", "--type=image", self.image_ref], stdout = devnull, stderr = devnull) == 0:
+        subprocess.call(["docker", "rmi", self.image_ref], stdout = devnull, stderr = devnull)
+    if self.prefetch_dir != None:
+      shutil.rmtree(self.prefetch_dir, True)
+    print("Background image download cancelled\n")
+
+def cancel_prefetch():
+  if prefetch_job != None:
+    prefetch_job.cancel()
+
+def start_prefetch():
+  global prefetch_job
+  if install_args.prefetch == False:
+    return
+  release_full_name = get_release_full_name()
+  if install_args.image_cache != None:
+    check_image_cache()
+    if image_cache_lookup(release_full_name, ["docker-archive", "sif"]) != None:
+      return
+
+  if install_args.container == "docker":
+    if find_executable("docker") == None:
+      return
+    # Never prefetch over an existing image, check_image_pre_install() reports that case
+    if get_docker_image_id(release_full_name) != None or get_docker_image_id("parabricks/release:" + install_args.release) != None:
+      return
+    cmd_lines = [["docker", "pull", release_full_name]]
+    if install_args.ngc == False:
+      cmd_lines = [["docker", "login", "registry.gitlab.com", "-u", "pbuser", "-p", install_args.access_token]] + cmd_lines + [["docker", "logout", "registry.gitlab.com"]]
+    prefetch_job = ImagePrefetch(cmd_lines, image_ref=release_full_name)
+  else:
+    # Only singularity 3.x builds a single image file that can be moved into place afterwards
+    if install_args.shared == True and get_shared_install_record() != None:
+      return
+    if find_local_docker_image() != None:
+      return
+    if find_executable("singularity") == None or os.getuid() != 0:
+      return
+    if "singularity version " not in probe_command(["singularity", "--version"])["output"]:
+      return
+    prefetch_parent = os.path.dirname(install_args.install_location)
+    if not os.path.isdir(prefetch_parent) or os.access(prefetch_parent, os.W_OK) == False:
+      prefetch_parent = None
+    prefetch_dir = tempfile.mkdtemp(prefix="pb_prefetch_", dir=prefetch_parent)
+    write_singularity_definition(prefetch_dir + "/pb.def", None)
+    newEnviron = os.environ.copy()
+    if install_args.ngc == False:
+      newEnviron["SINGULARITY_DOCKER_USERNAME"] = "pbuser"
+      newEnviron["SINGULARITY_DOCKER_PASSWORD"] = install_args.access_token
+    prefetch_job = ImagePrefetch([["singularity", "build", prefetch_dir + "/image.sif", prefetch_dir + "/pb.def"]], prefetch_dir=prefetch_dir, environ=newEnviron)
+
+  print("Downloading image in the background while installation options are confirmed\n")
+  atexit.register(cancel_prefetch)
+  prefetch_job.start()
+
 def install_docker_image():
-  check_image_pre_install()
-  os.chdir(install_args.install_location)
-  print("\nDownloading image\n")
   image_full_name = "parabricks/release:" + install_args.release
-  release_full_name = "registry.gitlab.com/pbuser/release/" + install_args.arch + ":" + install_args.release
-  if install_args.ngc == True:
-    release_full_name = "nvcr.io/hpc/parabricks:" + install_args.release
-    run_and_return(["docker", "pull", release_full_name], "Cannot download Parabricks docker image.", False, True)
-  else:
-    run_and_return(["docker", "login", "registry.gitlab.com", "-u", "pbuser", "-p", install_args.access_token], "Cannot contact Parabricks registry.")
-    run_and_return(["docker", "pull", release_full_name], "Cannot download Parabricks docker image.", False, True)
-    run_and_return(["docker", "logout", "registry.gitlab.com"], "Error logging out of Parabricks registry.")
+  release_full_name = get_release_full_name()
+  expected_image.clear()
+  if install_args.upgrade == True and docker_inspect_image(image_full_name) != None:
+    print("\nImage " + image_full_name + " is already installed, reusing it\n")
+    expected_digests = get_expected_docker_digests(release_full_name)
+    if expected_digests:
+      image_id = get_docker_image_id(image_full_name)
+      expected_digest = image_id if image_id in expected_digests else sorted(expected_digests)[0]
+      expected_image["digest"] = expected_digest
+      expected_image["source"] = expected_digests[expected_digest]
+    return False
+  prefetched = prefetch_job != None and prefetch_job.commit() == True
+  reused_ref = None
+  if prefetched == False and install_args.upgrade == False:
+    reused_ref = check_image_pre_install()
+  if reused_ref != None:
+    return install_present_docker_image(reused_ref, image_full_name, release_full_name)
+  with timeline.phase("pull") as pull_phase:
+    if prefetched == True:
+      print("\nUsing image downloaded during setup\n")
+      expect_pulled_docker_image(release_full_name)
+      store_docker_image_in_cache(release_full_name)
+    elif load_docker_image_from_cache(release_full_name) == False:
+      print("\nDownloading image\n")
+      docker_pull_image(release_full_name, "Cannot download Parabricks docker image.")
+      expect_pulled_docker_image(release_full_name)
+      store_docker_image_in_cache(release_full_name)
+    pull_phase["bytes"] = get_docker_image_size(release_full_name)
 
-  print("\nInstalling image\n")
-  run_and_return(["docker", "tag", release_full_name, image_full_name], "Could not build Parabricks image")
+  with timeline.phase("tag/inspect"):
+    print("\nInstalling image\n")
+    docker_tag_image(release_full_name, image_full_name, "Could not build Parabricks image")
 
-  if run_and_return(["docker", "inspect", "--type=image", image_full_name], "Image did not install correctly") == 0:
-    run_and_return(["docker", "rmi", release_full_name], "Removing base image was unsuccessful")
+    if docker_inspect_image(image_full_name) == None:
+      print("Image did not install correctly")
+      InstallAbort()
+    docker_remove_image(release_full_name, "Removing base image was unsuccessful")
     print("Image Installation successful.\n")
-  os.chdir(currentDir)
+  return True
+
+# Installs an image that was already present before this run. It is not
+# removed if the installation fails, as this run did not download it.
+def install_present_docker_image(image_ref, image_full_name, release_full_name):
+  if image_ref == image_full_name:
+    return False
+  with timeline.phase("tag/inspect"):
+    docker_tag_image(image_ref, image_full_name, "Could not build Parabricks image")
+    if docker_inspect_image(image_full_name) == None:
+      print("Image did not install correctly")
+      InstallAbort()
+    docker_remove_image(release_full_name, "Removing base image was unsuccessful")
+    print("Image Installation successful.\n")
+  return False
 
 def install_singularity_image(singularity_version):
   if "2.x" in singularity_version:
-    install_singularity_image_v2()
-  else:
-    install_singularity_image_v3()
+    return install_singularity_image_v2()
+  with timeline.phase("pull") as pull_phase:
+    installed = install_singularity_image_v3()
+    pull_phase["bytes"] = os.path.getsize(install_args.install_location + "/parabricks-release-" + install_args.release + ".sif")
+  return installed
+
+def load_pulled_docker_images():
+  try:
+    with open(PULLED_IMAGES_FILE, "r") as images_file:
+      return json.load(images_file)
+  except (IOError, OSError, ValueError):
+    return {}
+
+# Records the image Id a registry reference was pulled as on this host. The
+# install untags the registry reference, which also drops the RepoDigests of
+# the image, so later runs (e.g. a singularity install from the local docker
+# image) find the Id here. Returns the Id, or None if the image did not come
+# from the registry.
+def record_pulled_docker_image(image_ref):
+  image_info = docker_inspect_image(image_ref)
+  if image_info == None:
+    return None
+  repository = image_ref.rsplit(":", 1)[0]
+  repo_digests = [repo_digest for repo_digest in image_info.get("RepoDigests") or [] if repo_digest.startswith(repository + "@")]
+  if not repo_digests:
+    return None
+  try:
+    if not os.path.isdir(os.path.dirname(PULLED_IMAGES_FILE)):
+      os.makedirs(os.path.dirname(PULLED_IMAGES_FILE))
+    with locked_file(PULLED_IMAGES_FILE + ".lock"):
+      pulled_images = load_pulled_docker_images()
+      pulled_images[image_ref] = {"digest": image_info["Id"], "repo_digests": repo_digests, "pulled_at": time.time()}
+      write_json_atomic(PULLED_IMAGES_FILE, pulled_images)
+  except (IOError, OSError):
+    write_log("Could not record pulled image in " + PULLED_IMAGES_FILE + "\n")
+  return image_info["Id"]
+
+# The registry digest of a pulled image only exists until the registry
+# reference is untagged, so the install is verified against the Id the image had
+# right after the pull
+def expect_pulled_docker_image(image_ref):
+  image_id = record_pulled_docker_image(image_ref)
+  if image_id != None:
+    expected_image["digest"] = image_id
+    expected_image["source"] = "the registry pull"
+
+# Maps the digests recorded for the docker image of this release to where they
+# were recorded
+def get_expected_docker_digests(release_full_name):
+  expected_digests = {}
+  pulled_image = load_pulled_docker_images().get(release_full_name)
+  if pulled_image != None:
+    expected_digests[pulled_image["digest"]] = "the registry pull recorded in " + PULLED_IMAGES_FILE
+  install_record = load_inventory(install_args.install_root)["releases"].get(get_inventory_key("docker"))
+  if install_record != None and install_record["image"]["digest"] != None:
+    expected_digests[install_record["image"]["digest"]] = "the inventory"
+  if install_args.image_cache != None:
+    for entry in load_image_cache_index()["entries"].values():
+      if entry["format"] == "docker-archive" and release_full_name in entry["refs"]:
+        expected_digests[entry["digest"]] = "the image cache"
+  return expected_digests
+
+# Returns the image of this release in the local docker daemon, e.g. from an
+# earlier docker install on the same host. When the inventory, the image cache
+# or the record of pulls on this host know the digest of the release, the local
+# image must match it, otherwise it must have been pulled from the release
+# registry.
+def find_local_docker_image():
+  if get_docker_engine() == None and find_executable("docker") == None:
+    return None
+  release_full_name = get_release_full_name()
+  expected_digests = get_expected_docker_digests(release_full_name)
+  release_repository = release_full_name.rsplit(":", 1)[0]
+  for image_ref in ["parabricks/release:" + install_args.release, release_full_name]:
+    image_info = docker_inspect_image(image_ref)
+    if image_info == None:
+      continue
+    if expected_digests:
+      if image_info["Id"] in expected_digests:
+        return {"format": "docker-daemon", "ref": image_ref, "digest": image_info["Id"]}
+    elif any(repo_digest.startswith(release_repository + "@") for repo_digest in image_info.get("RepoDigests") or []):
+      return {"format": "docker-daemon", "ref": image_ref, "digest": image_info["Id"]}
+    write_log("Local docker image " + image_ref + " (" + image_info["Id"] + ") does not match release " + install_args.release + "\n")
+  return None
+
+def write_singularity_definition(definition_path, cached_image):
+  with open(definition_path, "w") as singularity_definition_file:
+    if cached_image != None and cached_image["format"] == "docker-daemon":
+      print("\nBuilding image from local docker image " + cached_image["ref"] + " (" + cached_image["digest"] + ")\n")
+      singularity_definition_file.write("Bootstrap: docker-daemon\n")
+      singularity_definition_file.write("From: " + cached_image["ref"] + "\n\n")
+    elif cached_image != None:
+      print("\nBuilding image from cached archive " + cached_image["digest"] + "\n")
+      singularity_definition_file.write("Bootstrap: docker-archive\n")
+      singularity_definition_file.write("From: " + cached_image["path"] + "\n\n")
+    else:
+      singularity_definition_file.write("Bootstrap: docker\n")
+      if install_args.ngc == True:
+        singularity_definition_file.write("From: hpc/parabricks" + ":" + install_args.release + "\n")
+        singularity_definition_file.write("Registry: nvcr.io\n\n")
+      else:
+        singularity_definition_file.write("From: pbuser/release/" + install_args.arch + ":" + install_args.release + "\n")
+        singularity_definition_file.write("Registry: registry.gitlab.com\n\n")
+    singularity_definition_file.write("%post\n")
+    singularity_definition_file.write("  chmod 777 /parabricks\n")
 
 def install_singularity_image_v3():
-  os.chdir(install_args.install_location)
-  image_full_name = "parabricks-release-" + install_args.release + ".sif"
+  image_full_name = install_args.install_location + "/parabricks-release-" + install_args.release + ".sif"
+  release_full_name = get_release_full_name()
   newEnviron = os.environ.copy()
   if install_args.ngc == False:
     newEnviron["SINGULARITY_DOCKER_USERNAME"] = "pbuser"
     newEnviron["SINGULARITY_DOCKER_PASSWORD"] = install_args.access_token
 
-  with open("pb.def", "w") as singularity_definition_file:
-    singularity_definition_file.write("Bootstrap: docker\n")
-    if install_args.ngc == True:
-      singularity_definition_file.write("From: hpc/parabricks" + ":" + install_args.release + "\n")
-      singularity_definition_file.write("Registry: nvcr.io\n\n")
-    else:
-      singularity_definition_file.write("From: pbuser/release/" + install_args.arch + ":" + install_args.release + "\n")
-      singularity_definition_file.write("Registry: registry.gitlab.com\n\n")
-    singularity_definition_file.write("%post\n")
-    singularity_definition_file.write("  chmod 777 /parabricks\n")
-  run_and_return(["singularity", "build", image_full_name, "pb.def"], "Could not download singularity image", False, True, newEnviron)
-  os.remove("pb.def")
-  os.chdir(currentDir)
+  if install_args.upgrade == True and os.path.isfile(image_full_name):
+    print("\nImage " + image_full_name + " is already installed, reusing it\n")
+    return False
+
+  if prefetch_job != None and prefetch_job.commit() == True:
+    print("\nUsing image downloaded during setup\n")
+    shutil.move(prefetch_job.prefetch_dir + "/image.sif", image_full_name)
+    shutil.rmtree(prefetch_job.prefetch_dir, True)
+    store_singularity_image_in_cache(release_full_name, "sif", image_full_name)
+    return True
+
+  cached_image = image_cache_lookup(release_full_name, ["sif", "docker-archive"])
+  if cached_image != None and cached_image["format"] == "sif":
+    print("\nCopying image " + cached_image["digest"] + " from cache\n")
+    link_or_copy(cached_image["path"], image_full_name)
+    return True
+  if cached_image == None:
+    cached_image = find_local_docker_image()
+
+  definition_fd, definition_path = tempfile.mkstemp(prefix="pb_", suffix=".def")
+  os.close(definition_fd)
+  try:
+    write_singularity_definition(definition_path, cached_image)
+    run_with_progress(["singularity", "build", image_full_name, definition_path], "Could not download singularity image", newEnviron)
+  finally:
+    os.remove(definition_path)
+  if cached_image == None or cached_image["format"] == "docker-daemon":
+    store_singularity_image_in_cache(release_full_name, "sif", image_full_name)
+  return True
 
 #def install_singularity_image_v3():
 #  os.chdir(install_args.install_location)
@@ -333,48 +1606,437 @@ def install_singularity_image_v3():
 #  os.chdir(currentDir)
 
 def install_singularity_image_v2():
-  os.chdir(install_args.install_location)
+  install_folder = install_args.install_location
   print("\nDownloading image\n")
-  image_full_name = "parabricks-release-" + install_args.release + ".simg"
-  release_full_name = "registry.gitlab.com/pbuser/release/" + install_args.arch + ":" + install_args.release
+  image_full_name = install_folder + "/parabricks-release-" + install_args.release + ".simg"
+  release_full_name = get_release_full_name()
+  newEnviron = os.environ.copy()
 
-  if install_args.ngc == True:
-    release_full_name = "nvcr.io/hpc/parabricks:" + install_args.release
-    run_and_return(["singularity", "pull", "docker://" + release_full_name], "Could not download singularity image", False, True, newEnviron)
-  else:
-    newEnviron = os.environ.copy()
-    newEnviron["SINGULARITY_DOCKER_USERNAME"] = "pbuser"
-    newEnviron["SINGULARITY_DOCKER_PASSWORD"] = install_args.access_token
-    run_and_return(["singularity", "pull", "docker://" + release_full_name], "Could not download singularity image", False, True, newEnviron)
-  run_and_return(["mv", install_args.arch + "-" + install_args.release + ".simg", image_full_name], "Could not copy singularity image", False, True)
+  installed = True
+  with timeline.phase("pull") as pull_phase:
+    cached_image = image_cache_lookup(release_full_name, ["simg"])
+    if install_args.upgrade == True and os.path.isfile(image_full_name):
+      print("Image " + image_full_name + " is already installed, reusing it\n")
+      installed = False
+    elif cached_image != None:
+      print("Copying image " + cached_image["digest"] + " from cache\n")
+      link_or_copy(cached_image["path"], image_full_name)
+    else:
+      if install_args.ngc == False:
+        newEnviron["SINGULARITY_DOCKER_USERNAME"] = "pbuser"
+        newEnviron["SINGULARITY_DOCKER_PASSWORD"] = install_args.access_token
+      run_with_progress(["singularity", "pull", "docker://" + release_full_name], "Could not download singularity image", newEnviron, install_folder)
+      run_and_return(["mv", install_folder + "/" + install_args.arch + "-" + install_args.release + ".simg", image_full_name], "Could not copy singularity image", False, True)
+      store_singularity_image_in_cache(release_full_name, "simg", image_full_name)
+    pull_phase["bytes"] = os.path.getsize(image_full_name)
 
-  print("\nInstalling image\n")
-  run_and_return(["singularity", "image.create", "pb-overlay.img"], "Could not build Parabricks image", False, True)
-  run_and_return(["chmod", "777", "pb-overlay.img"], "Could not fix permissions", False, False)
+  with timeline.phase("tag/inspect"):
+    print("\nInstalling image\n")
+    run_and_return(["singularity", "image.create", install_folder + "/pb-overlay.img"], "Could not build Parabricks image", False, True)
+    run_and_return(["chmod", "777", install_folder + "/pb-overlay.img"], "Could not fix permissions", False, False)
 
-  print("Checking if image installed successfully\n")
-  if run_and_return(["singularity", "inspect", image_full_name], "Image did not install correctly") == 0:
-    print("Image Installation successful.\n")
-  os.chdir(currentDir)
+    print("Checking if image installed successfully\n")
+    if run_and_return(["singularity", "inspect", image_full_name], "Image did not install correctly") == 0:
+      print("Image Installation successful.\n")
+  return installed
 
+# Returns True if the image was installed by this run, False if an installed one
+# was reused
 def install_image(runCmd):
   if install_args.container == "docker":
-    install_docker_image()
-  else:
-    install_singularity_image(runCmd)
+    return install_docker_image()
+  return install_singularity_image(runCmd)
+
+# Rollback of the image step. Removes the image this run installed, otherwise
+# the next attempt stops at check_image_pre_install.
+def remove_installed_image(install_folder):
+  if install_args.container == "docker":
+    remove_docker_image_if_present("parabricks/release:" + install_args.release)
+    return
+  for file_name in ["parabricks-release-" + install_args.release + ".sif", "parabricks-release-" + install_args.release + ".simg", "pb-overlay.img"]:
+    remove_file(install_folder + "/" + file_name)
+
+# Writes a release tarball member for --upgrade. The member is hashed while it
+# is read, and if the current installation has the same file it is hardlinked
+# instead of written. Returns the number of bytes written.
+def upgrade_release_member(release_tar, member, install_folder, current_folder):
+  target_path = os.path.join(install_folder, member.name)
+  current_path = os.path.join(current_folder, member.name)
+  with tempfile.SpooledTemporaryFile(16 * 1048576) as spool_file:
+    script_manifest[member.name] = copy_hashed(release_tar.extractfile(member), spool_file)
+    if not os.path.isdir(os.path.dirname(target_path)):
+      os.makedirs(os.path.dirname(target_path))
+    written_bytes = 0
+    if os.path.isfile(current_path) and not os.path.islink(current_path) and os.path.getsize(current_path) == member.size and hash_file(current_path) == script_manifest[member.name]:
+      link_or_copy(current_path, target_path)
+    else:
+      spool_file.seek(0)
+      with open(target_path, "wb") as target_file:
+        shutil.copyfileobj(spool_file, target_file)
+      written_bytes = member.size
+  release_tar.chmod(member, target_path)
+  release_tar.utime(member, target_path)
+  return written_bytes
+
+# Copies a file object and returns the hash of what was copied
+def copy_hashed(source_file, target_file):
+  file_hash = hashlib.sha256()
+  chunk = source_file.read(1048576)
+  while chunk:
+    file_hash.update(chunk)
+    target_file.write(chunk)
+    chunk = source_file.read(1048576)
+  return "sha256:" + file_hash.hexdigest()
+
+# Writes a release tarball member, hashing it while it streams out of the
+# tarball. Returns the number of bytes written.
+def write_release_member(release_tar, member, install_folder):
+  target_path = os.path.join(install_folder, member.name)
+  if not os.path.isdir(os.path.dirname(target_path)):
+    os.makedirs(os.path.dirname(target_path))
+  if os.path.lexists(target_path):
+    os.remove(target_path)
+  with open(target_path, "wb") as target_file:
+    script_manifest[member.name] = copy_hashed(release_tar.extractfile(member), target_file)
+  release_tar.chmod(member, target_path)
+  release_tar.utime(member, target_path)
+  return member.size
+
+# Extracts release-<ver>/ from a (possibly non-seekable) release tarball stream
+# directly into the install folder and records the hash of every file as it was
+# read from the tarball in script_manifest, so verifying the installed files
+# against it catches bad writes. Returns the number of bytes written.
+def extract_release_scripts(tar_fileobj, install_folder):
+  release_prefix = "release-" + install_args.release + "/"
+  copied_bytes = 0
+  script_manifest.clear()
+  current_folder = None
+  reused_files = 0
+  if install_args.upgrade == True and os.path.isdir(install_args.install_root + "/parabricks"):
+    current_folder = install_args.install_root + "/parabricks"
+  release_tar = tarfile.open(fileobj=tar_fileobj, mode="r|gz")
+  try:
+    for member in release_tar:
+      member_name = member.name
+      if member_name.startswith("./"):
+        member_name = member_name[2:]
+      link_name = member.linkname
+      if link_name.startswith("./"):
+        link_name = link_name[2:]
+      if not member_name.startswith(release_prefix) or member_name == release_prefix:
+        continue
+      member.name = member_name[len(release_prefix):]
+      if os.path.isabs(member.name) or ".." in member.name.split("/"):
+        write_log("Skipping unsafe path in release tarball: " + member_name + "\n")
+        continue
+      if member.islnk() and link_name.startswith(release_prefix):
+        member.linkname = link_name[len(release_prefix):]
+      if member.isfile() and current_folder != None:
+        written_bytes = upgrade_release_member(release_tar, member, install_folder, current_folder)
+        if written_bytes == 0 and member.size > 0:
+          reused_files += 1
+        copied_bytes += written_bytes
+        continue
+      if member.isfile():
+        copied_bytes += write_release_member(release_tar, member, install_folder)
+        continue
+      release_tar.extract(member, install_folder)
+  finally:
+    release_tar.close()
+  if current_folder != None:
+    print("Reused %d unchanged files, wrote %d added or changed files\n" % (reused_files, len(script_manifest) - reused_files))
+  return copied_bytes
+
+# Extracts the release tarball from a tar stream as produced by docker cp ... -
+def extract_release_from_archive(archive_stream, release_tarball):
+  copied_bytes = None
+  archive_tar = tarfile.open(fileobj=archive_stream, mode="r|")
+  for archive_member in archive_tar:
+    if archive_member.isfile() and archive_member.name == os.path.basename(release_tarball):
+      copied_bytes = extract_release_scripts(archive_tar.extractfile(archive_member), install_args.install_location)
+  archive_tar.close()
+  return copied_bytes
+
+def stream_scripts_with_engine(engine, image_full_name, release_tarball):
+  # The container is only created, never started, it just gives the archive endpoint something to read from
+  try:
+    container_id = engine.create_container(image_full_name, ["version"])
+  except DockerEngineError as exc:
+    write_log(str(exc) + "\n")
+    print("Could not initiate scripts copying. Exiting...\n")
+    InstallAbort()
+  copied_bytes = None
+  try:
+    connection, response = engine.get_archive(container_id, release_tarball)
+    try:
+      copied_bytes = extract_release_from_archive(response, release_tarball)
+      response.read()
+      engine.release(connection, response)
+    except (tarfile.TarError, IOError, OSError, EOFError) as exc:
+      connection.close()
+      raise
+  except (DockerEngineError, tarfile.TarError, IOError, OSError, EOFError) as exc:
+    write_log("Streaming release scripts failed: " + str(exc) + "\n")
+  try:
+    engine.remove_container(container_id)
+  except DockerEngineError as exc:
+    write_log(str(exc) + "\n")
+    print("Could not properly complete downloading scripts. Exiting ...\n")
+    InstallAbort()
+  return copied_bytes
+
+def stream_scripts_with_cli(image_full_name, release_tarball):
+  # docker create does not start the container, it only gives docker cp something to read from
+  container_id = run_and_capture(["docker", "create", image_full_name, "version"], "Could not initiate scripts copying. Exiting...\n").strip()
+  cp_cmd_line = ["docker", "cp", container_id + ":" + release_tarball, "-"]
+  write_log("+ " + " ".join(cp_cmd_line) + "\n")
+  copied_bytes = None
+  cp_proc = subprocess.Popen(cp_cmd_line, stdout = subprocess.PIPE, stderr = log_file)
+  try:
+    copied_bytes = extract_release_from_archive(cp_proc.stdout, release_tarball)
+  except (tarfile.TarError, IOError, OSError, EOFError) as exc:
+    write_log("Streaming release scripts failed: " + str(exc) + "\n")
+    copied_bytes = None
+  finally:
+    cp_proc.stdout.close()
+    if cp_proc.wait() != 0:
+      copied_bytes = None
+  run_and_return(["docker", "rm", "-f", container_id], "Could not properly complete downloading scripts. Exiting ...\n", False, False)
+  return copied_bytes
 
 def install_docker_scripts():
-  install_folder = install_args.install_location
   image_full_name = "parabricks/release:" + install_args.release
+  release_tarball = "/parabricks/release-" + install_args.release + ".tar.gz"
+  start_time = time.time()
+
+  copied_bytes = call_docker(lambda engine: stream_scripts_with_engine(engine, image_full_name, release_tarball),
+                             lambda: stream_scripts_with_cli(image_full_name, release_tarball))
+  if copied_bytes == None:
+    print("Could not properly download scripts. Exiting ...\n")
+    InstallAbort()
+  elapsed = time.time() - start_time
+  print("Copied %.1f MB of release scripts in %.1f s\n" % (copied_bytes / 1048576.0, elapsed))
+  write_log("Streamed %d bytes of release scripts in %.3f s\n" % (copied_bytes, elapsed))
+  return copied_bytes
+
+class ImageFormatError(Exception):
+  pass
+
+IMAGE_READ_ERRORS = (ImageFormatError, tarfile.TarError, struct.error, zlib.error, IOError, OSError, EOFError)
+if lzma != None:
+  IMAGE_READ_ERRORS = IMAGE_READ_ERRORS + (lzma.LZMAError,)
+
+# File-like wrapper so tarfile can stream from a generator of byte chunks
+class ChunkReader(object):
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+    self.buffer = b""
+
+  def read(self, size=-1):
+    while size < 0 or len(self.buffer) < size:
+      chunk = next(self.chunks, None)
+      if chunk == None:
+        break
+      self.buffer += chunk
+    if size < 0:
+      data, self.buffer = self.buffer, b""
+    else:
+      data, self.buffer = self.buffer[:size], self.buffer[size:]
+    return data
+
+class MetadataCursor(object):
+  def __init__(self, squashfs, block_position, offset):
+    self.squashfs = squashfs
+    self.next_block = block_position
+    self.buffer = b""
+    self.load_block()
+    self.buffer = self.buffer[offset:]
+
+  def load_block(self):
+    data, self.next_block = self.squashfs.read_metadata_block(self.next_block)
+    self.buffer += data
+
+  def read(self, size):
+    while len(self.buffer) < size:
+      self.load_block()
+    data, self.buffer = self.buffer[:size], self.buffer[size:]
+    return data
+
+# Minimal read-only squashfs 4.0 reader, enough to locate and stream a single file
+# out of a SIF/SIMG image without unpacking the rest of it.
+class SquashfsImage(object):
+  def __init__(self, image_file, offset):
+    self.image_file = image_file
+    self.offset = offset
+    superblock = self.read_at(0, 96)
+    if len(superblock) < 96:
+      raise ImageFormatError("Truncated squashfs superblock")
+    (magic, self.inode_count, mod_time, self.block_size, self.fragment_count, self.compression,
+     block_log, flags, id_count, version_major, version_minor, self.root_inode, bytes_used,
+     id_table, xattr_table, self.inode_table, self.directory_table, self.fragment_table,
+     export_table) = struct.unpack("<4sIIIIHHHHHHQQQQQQQQ", superblock)
+    if magic != SQUASHFS_MAGIC or version_major != 4:
+      raise ImageFormatError("Not a squashfs 4.0 filesystem")
+    self.metadata_blocks = {}
+
+  def read_at(self, position, size):
+    self.image_file.seek(self.offset + position)
+    return self.image_file.read(size)
 
-  run_and_return(["docker", "run", "--name=raw_run", image_full_name, "version" ], "Could not initiate scripts copying. Exiting...\n", False, False)
-  run_and_return(["docker", "cp", "raw_run:/parabricks/release-" + install_args.release + ".tar.gz", install_folder], "Could not properly download scripts. Exiting ...\n", False, False)
-  run_and_return(["docker", "rm", "-f", "raw_run"], "Could not properly complete downloading scripts. Exiting ...\n", False, False)
+  def decompress(self, data):
+    if self.compression == 1:
+      return zlib.decompress(data)
+    if self.compression == 4 and lzma != None:
+      return lzma.decompress(data)
+    raise ImageFormatError("Unsupported squashfs compression id " + str(self.compression))
 
-  run_and_return(["tar", "-xzf", install_folder + "/release-" + install_args.release + ".tar.gz", "-C", install_folder], "Could not properly untar release scripts")
-  copy_tree(install_folder + "/release-" + install_args.release, install_folder)
-  os.remove(install_folder + "/release-" + install_args.release + ".tar.gz")
-  shutil.rmtree(install_folder + "/release-" + install_args.release)
+  def read_metadata_block(self, position):
+    if position not in self.metadata_blocks:
+      block_header = struct.unpack("<H", self.read_at(position, 2))[0]
+      block_size = block_header & 0x7FFF
+      data = self.read_at(position + 2, block_size)
+      if not block_header & 0x8000:
+        data = self.decompress(data)
+      self.metadata_blocks[position] = (data, position + 2 + block_size)
+    return self.metadata_blocks[position]
+
+  def read_inode(self, inode_ref):
+    cursor = MetadataCursor(self, self.inode_table + (inode_ref >> 16), inode_ref & 0xFFFF)
+    inode_type = struct.unpack("<HHHHII", cursor.read(16))[0]
+    if inode_type == 1:
+      block_index, link_count, file_size, block_offset, parent = struct.unpack("<IIHHI", cursor.read(16))
+      return {"type": "dir", "block_index": block_index, "block_offset": block_offset, "file_size": file_size}
+    if inode_type == 8:
+      link_count, file_size, block_index, parent, index_count, block_offset, xattr = struct.unpack("<IIIIHHI", cursor.read(24))
+      return {"type": "dir", "block_index": block_index, "block_offset": block_offset, "file_size": file_size}
+    if inode_type == 2:
+      blocks_start, fragment_index, fragment_offset, file_size = struct.unpack("<IIII", cursor.read(16))
+    elif inode_type == 9:
+      blocks_start, file_size, sparse, link_count, fragment_index, fragment_offset, xattr = struct.unpack("<QQQIIII", cursor.read(40))
+    else:
+      return {"type": "other"}
+    block_count = file_size // self.block_size
+    if fragment_index == 0xFFFFFFFF and file_size % self.block_size:
+      block_count += 1
+    block_sizes = struct.unpack("<" + str(block_count) + "I", cursor.read(4 * block_count))
+    return {"type": "file", "blocks_start": blocks_start, "file_size": file_size, "block_sizes": block_sizes,
+            "fragment_index": fragment_index, "fragment_offset": fragment_offset}
+
+  def list_directory(self, inode):
+    entries = {}
+    remaining = inode["file_size"] - 3
+    if remaining <= 0:
+      return entries
+    cursor = MetadataCursor(self, self.directory_table + inode["block_index"], inode["block_offset"])
+    while remaining > 0:
+      entry_count, inode_block, inode_number = struct.unpack("<IIi", cursor.read(12))
+      remaining -= 12
+      for i in range(entry_count + 1):
+        entry_offset, inode_delta, entry_type, name_size = struct.unpack("<HhHH", cursor.read(8))
+        entry_name = cursor.read(name_size + 1).decode("utf-8", "replace")
+        remaining -= 8 + name_size + 1
+        entries[entry_name] = (inode_block << 16) | entry_offset
+    return entries
+
+  def lookup(self, path):
+    inode = self.read_inode(self.root_inode)
+    for path_part in path.strip("/").split("/"):
+      if inode["type"] != "dir":
+        raise ImageFormatError(path + " not found in image")
+      entries = self.list_directory(inode)
+      if path_part not in entries:
+        raise ImageFormatError(path + " not found in image")
+      inode = self.read_inode(entries[path_part])
+    return inode
+
+  def read_fragment(self, fragment_index):
+    pointer_position = self.fragment_table + 8 * (fragment_index // 512)
+    metadata_position = struct.unpack("<Q", self.read_at(pointer_position, 8))[0]
+    cursor = MetadataCursor(self, metadata_position, 16 * (fragment_index % 512))
+    fragment_start, fragment_size, unused = struct.unpack("<QII", cursor.read(16))
+    data = self.read_at(fragment_start, fragment_size & 0xFFFFFF)
+    if not fragment_size & 0x1000000:
+      data = self.decompress(data)
+    return data
+
+  def iter_file(self, path):
+    inode = self.lookup(path)
+    if inode["type"] != "file":
+      raise ImageFormatError(path + " is not a regular file in image")
+    position = inode["blocks_start"]
+    remaining = inode["file_size"]
+    for block_size in inode["block_sizes"]:
+      stored_size = block_size & 0xFFFFFF
+      if stored_size == 0:
+        data = b"\0" * min(self.block_size, remaining)
+      else:
+        data = self.read_at(position, stored_size)
+        position += stored_size
+        if not block_size & 0x1000000:
+          data = self.decompress(data)
+      data = data[:remaining]
+      remaining -= len(data)
+      yield data
+    if remaining > 0 and inode["fragment_index"] != 0xFFFFFFFF:
+      fragment = self.read_fragment(inode["fragment_index"])
+      yield fragment[inode["fragment_offset"]:inode["fragment_offset"] + remaining]
+      remaining = 0
+    if remaining > 0:
+      raise ImageFormatError("Truncated file " + path + " in image")
+
+# Returns the offset of the root squashfs filesystem in a SIF (v3) or SIMG (v2) image
+def find_squashfs_offset(image_file):
+  image_file.seek(0)
+  header = image_file.read(128)
+  if header[32:41] == SIF_MAGIC:
+    descriptors_total, descriptors_offset = struct.unpack("<qq", header[88:104])
+    descriptor_size = struct.calcsize(SIF_DESCRIPTOR_FORMAT)
+    partitions = []
+    for i in range(descriptors_total):
+      image_file.seek(descriptors_offset + i * descriptor_size)
+      descriptor = struct.unpack(SIF_DESCRIPTOR_FORMAT, image_file.read(descriptor_size))
+      data_type, used, data_offset, extra = descriptor[0], descriptor[1], descriptor[5], descriptor[13]
+      if used and data_type == SIF_DATA_PARTITION:
+        fs_type, part_type = struct.unpack("<ii", extra[:8])
+        if fs_type == SIF_FS_SQUASH:
+          partitions.append((part_type != SIF_PART_PRIMSYS, data_offset))
+    if not partitions:
+      raise ImageFormatError("No squashfs partition in SIF image")
+    return sorted(partitions)[0][1]
+
+  # SIMG images are a squashfs filesystem behind a short launch script header
+  image_file.seek(0)
+  header = image_file.read(65536)
+  squashfs_offset = header.find(SQUASHFS_MAGIC)
+  if squashfs_offset < 0:
+    raise ImageFormatError("No squashfs filesystem found in image")
+  return squashfs_offset
+
+# The SIF header carries a unique ID that is generated when the image is built
+def read_sif_id(image_path):
+  try:
+    with open(image_path, "rb") as image_file:
+      header = image_file.read(64)
+  except (IOError, OSError):
+    return None
+  if header[32:41] != SIF_MAGIC:
+    return None
+  return "sif-id:" + base64.b16encode(header[48:64]).decode("ascii").lower()
+
+def install_singularity_scripts_from_sandbox(image_path, install_folder):
+  sandbox_parent = tempfile.mkdtemp(prefix="pb_sb_" + install_args.release + "_")
+  sandbox_dir = sandbox_parent + "/sandbox"
+  try:
+    run_and_return(["singularity", "build", "--sandbox", sandbox_dir, image_path], "Could not initiate scripts copying", False, False)
+    with open(sandbox_dir + "/parabricks/release-" + install_args.release + ".tar.gz", "rb") as release_tarball:
+      copied_bytes = extract_release_scripts(release_tarball, install_folder)
+  except (tarfile.TarError, IOError, OSError, EOFError) as exc:
+    write_log(str(exc) + "\n")
+    print("Could not properly untar release scripts")
+    InstallAbort()
+  finally:
+    shutil.rmtree(sandbox_parent, True)
+  return copied_bytes
 
 def install_singularity_scripts(runCmd):
   install_folder = install_args.install_location
@@ -383,59 +2045,751 @@ def install_singularity_scripts(runCmd):
     image_full_name = image_full_name + ".sif"
   else:
     image_full_name = image_full_name + ".simg"
-  run_and_return(["singularity", "build", "--sandbox", "/tmp/pb_sb_" + install_args.release, install_folder + "/" + image_full_name], "Could not initiate scripts copying", False, False)
-  run_and_return(["cp", "/tmp/pb_sb_" + install_args.release + "/parabricks/release-" + install_args.release + ".tar.gz", install_folder], "Copying from sandbox failed", False, False)
-  shutil.rmtree("/tmp/pb_sb_" + install_args.release)
+  image_path = install_folder + "/" + image_full_name
+  release_tarball = "/parabricks/release-" + install_args.release + ".tar.gz"
+  start_time = time.time()
+
+  write_log("+ read " + release_tarball + " from " + image_path + "\n")
+  copied_bytes = None
+  try:
+    with open(image_path, "rb") as image_file:
+      squashfs = SquashfsImage(image_file, find_squashfs_offset(image_file))
+      copied_bytes = extract_release_scripts(ChunkReader(squashfs.iter_file(release_tarball)), install_folder)
+  except IMAGE_READ_ERRORS as exc:
+    write_log("Reading release scripts from image failed: " + str(exc) + "\n")
+    print("Could not read scripts directly from the image, building a sandbox instead\n")
+    copied_bytes = install_singularity_scripts_from_sandbox(image_path, install_folder)
 
-  run_and_return(["tar", "-xzf", install_folder + "/release-" + install_args.release + ".tar.gz", "-C", install_folder], "Could not properly untar release scripts")
-  copy_tree(install_folder + "/release-" + install_args.release, install_folder)
-  os.remove(install_folder + "/release-" + install_args.release + ".tar.gz")
-  shutil.rmtree(install_folder + "/release-" + install_args.release)
+  elapsed = time.time() - start_time
+  print("Copied %.1f MB of release scripts in %.1f s\n" % (copied_bytes / 1048576.0, elapsed))
+  write_log("Extracted %d bytes of release scripts in %.3f s\n" % (copied_bytes, elapsed))
+  return copied_bytes
 
 def install_scripts(install_folder, runCmd):
-  print("Copying Scripts\n")
-  if install_args.container == "docker":
-    install_docker_scripts()
-  else:
-    install_singularity_scripts(runCmd)
+  with timeline.phase("script extraction") as extraction_phase:
+    print("Copying Scripts\n")
+    if install_args.container == "docker":
+      extraction_phase["bytes"] = install_docker_scripts()
+    else:
+      extraction_phase["bytes"] = install_singularity_scripts(runCmd)
+
+  create_pbrun_symlink()
 
+def create_pbrun_symlink():
   if install_args.symlink == True:
     try:
       if os.path.lexists("/usr/bin/pbrun"):
         os.unlink("/usr/bin/pbrun")
-      os.symlink(install_folder + "/pbrun", "/usr/bin/pbrun")
+      os.symlink(install_args.install_root + "/parabricks/pbrun", "/usr/bin/pbrun")
     except OSError as exc:
       print("Could not create symlink /usr/bin/pbrun. Permission denied")
 
-def install_parabricks(script_dir):
-  runCmd = check_requirements(install_args.cpu_only)
+class InstallStep(object):
+  def __init__(self, name, func, deps=(), rollback=None):
+    self.name = name
+    self.func = func
+    self.deps = list(deps)
+    self.rollback = rollback
+    self.scheduler = None
+    self.state = "pending"
+    self.start_time = None
+    self.end_time = None
+
+# Runs InstallSteps as soon as their dependencies are done, several at a time.
+# The first failing step cancels the running ones (their child processes are
+# terminated), and the rollbacks of completed steps run in reverse order.
+class StepScheduler(object):
+  def __init__(self, steps, max_workers=4):
+    self.steps = steps
+    self.max_workers = max_workers
+    self.results = {}
+    self.failed_step = None
+    self.completed = []
+    self.processes = set()
+    self.condition = threading.Condition()
+    for step in steps:
+      step.scheduler = self
+
+  def track_process(self, cmd_proc):
+    with self.condition:
+      self.processes.add(cmd_proc)
+      if self.failed_step != None:
+        cmd_proc.terminate()
+
+  def untrack_process(self, cmd_proc):
+    with self.condition:
+      self.processes.discard(cmd_proc)
+
+  def run_step(self, step):
+    step_context.step = step
+    step.start_time = time.time()
+    write_log("started\n")
+    state = "failed"
+    try:
+      self.results[step.name] = step.func(self.results)
+      state = "done"
+    except InstallError:
+      pass
+    except Exception as exc:
+      print(step.name + " failed: " + str(exc))
+    finally:
+      step.end_time = time.time()
+      write_log(state + " after %.1f s\n" % (step.end_time - step.start_time))
+      step_context.step = None
+    with self.condition:
+      step.state = state
+      if step.state == "done":
+        self.completed.append(step)
+      elif self.failed_step == None:
+        self.failed_step = step
+        for cmd_proc in self.processes:
+          if cmd_proc.poll() == None:
+            cmd_proc.terminate()
+      else:
+        step.state = "cancelled"
+      self.condition.notify_all()
+
+  def run(self):
+    steps_by_name = dict((step.name, step) for step in self.steps)
+    with self.condition:
+      while True:
+        running = len([step for step in self.steps if step.state == "running"])
+        if self.failed_step == None:
+          for step in self.steps:
+            if running >= self.max_workers:
+              break
+            if step.state == "pending" and all(steps_by_name[dep].state == "done" for dep in step.deps):
+              step.state = "running"
+              running += 1
+              step_thread = threading.Thread(target=self.run_step, args=(step,))
+              step_thread.daemon = True
+              step_thread.start()
+        if running == 0:
+          break
+        self.condition.wait()
+
+    if self.failed_step == None:
+      return True
+    print("\nInstallation step '" + self.failed_step.name + "' failed, rolling back\n")
+    for step in reversed(self.completed):
+      if step.rollback != None:
+        write_log("[" + step.name + "] rolling back\n")
+        try:
+          step.rollback(self.results)
+        except (IOError, OSError) as exc:
+          write_log("[" + step.name + "] rollback failed: " + str(exc) + "\n")
+    return False
+
+  # The critical path ends at the step that finished last and walks back through
+  # the dependency that finished last, i.e. the one that actually gated each step.
+  def critical_path(self):
+    finished = [step for step in self.steps if step.end_time != None]
+    if not finished:
+      return []
+    steps_by_name = dict((step.name, step) for step in self.steps)
+    path = [max(finished, key=lambda step: step.end_time)]
+    while path[-1].deps:
+      path.append(max((steps_by_name[dep] for dep in path[-1].deps), key=lambda step: step.end_time or 0))
+    return list(reversed(path))
+
+  def format_critical_path(self):
+    return " -> ".join(step.name + " (%.1f s)" % (step.end_time - step.start_time) for step in self.critical_path())
+
+def copy_license(script_dir, install_folder):
+  if os.path.abspath(script_dir + "/license.bin") != os.path.abspath(install_folder + "/license.bin"):
+    shutil.copy(script_dir + "/license.bin", install_folder + "/license.bin" )
+    return True
+  return False
+
+def remove_file(file_path):
+  if os.path.lexists(file_path):
+    os.remove(file_path)
+
+# Written atomically, nodes sharing the install folder may read it at any time
+def write_config(install_folder, runCmd):
+  with timeline.phase("config write") as config_phase:
+    config_path = install_folder + "/config.txt"
+    config_text = runCmd + "\n" + install_args.arch + "\n"
+    if os.path.isfile(config_path):
+      with open(config_path, "r") as f:
+        if f.read() == config_text:
+          return
+    with open(config_path + get_tmp_suffix(), "w") as f:
+      f.write(config_text)
+    os.rename(config_path + get_tmp_suffix(), config_path)
+    config_phase["bytes"] = len(config_text)
+
+# The inventory index in the install root records what the installer put on the
+# node, so --status and --uninstall do not have to rediscover it.
+def inventory_path(install_root):
+  return install_root + "/" + INVENTORY_FILE
+
+# Releases are recorded per container type, the same release can be installed
+# for both docker and singularity
+def get_inventory_key(container):
+  return install_args.release + "/" + container
+
+def load_inventory(install_root):
+  try:
+    with open(inventory_path(install_root), "r") as inventory_file:
+      return json.load(inventory_file)
+  except (IOError, OSError, ValueError):
+    return {"releases": {}}
+
+def get_image_record(install_folder, runCmd):
+  if install_args.container == "docker":
+    image_ref = "parabricks/release:" + install_args.release
+    image_info = docker_inspect_image(image_ref) or {}
+    return {"ref": image_ref, "digest": image_info.get("Id"), "repo_digests": image_info.get("RepoDigests") or [], "size": image_info.get("Size", 0)}
+  image_path = install_folder + "/parabricks-release-" + install_args.release
+  if "3.x" in runCmd:
+    image_path = image_path + ".sif"
+  else:
+    image_path = image_path + ".simg"
+  image_stat = os.stat(image_path)
+  return {"path": image_path, "digest": read_sif_id(image_path), "size": image_stat.st_size, "mtime": image_stat.st_mtime}
+
+def get_install_record(install_folder, runCmd):
+  symlink = None
+  if os.path.islink("/usr/bin/pbrun") and os.readlink("/usr/bin/pbrun") == install_folder + "/pbrun":
+    symlink = "/usr/bin/pbrun"
+  return {
+    "release": install_args.release,
+    "container": install_args.container,
+    "run_command": runCmd,
+    "arch": install_args.arch,
+    "install_folder": install_folder,
+    "image": get_image_record(install_folder, runCmd),
+    "scripts": dict(script_manifest),
+    "symlink": symlink,
+    "host": socket.gethostname(),
+    "hosts": [socket.gethostname()],
+    "installed_at": time.time(),
+  }
+
+# Checks an installation against its record: the image digest (or SIF header
+# ID, size and mtime) and the hash of every script, hashed in parallel. Running
+# pbrun version starts a container, so it is only done as a deep check.
+def verify_image(image_record, container):
+  if container == "docker":
+    image_info = docker_inspect_image(image_record["ref"])
+    if image_info == None:
+      return "image " + image_record["ref"] + " is not installed"
+    if image_record["digest"] != None and image_info["Id"] != image_record["digest"]:
+      return "image " + image_record["ref"] + " is " + image_info["Id"] + ", expected " + image_record["digest"]
+    return None
+  try:
+    image_stat = os.stat(image_record["path"])
+    with open(image_record["path"], "rb") as image_file:
+      find_squashfs_offset(image_file)
+  except (IOError, OSError) as exc:
+    return "image " + image_record["path"] + " is not readable: " + str(exc)
+  except ImageFormatError as exc:
+    return "image " + image_record["path"] + " is damaged: " + str(exc)
+  if image_stat.st_size != image_record["size"] or image_stat.st_mtime != image_record["mtime"]:
+    return "image " + image_record["path"] + " was modified after installation"
+  if image_record["digest"] != None and read_sif_id(image_record["path"]) != image_record["digest"]:
+    return "image " + image_record["path"] + " is not the installed image " + image_record["digest"]
+  return None
+
+def verify_scripts(install_folder, manifest):
+  def check_script(script_path):
+    try:
+      if hash_file(os.path.join(install_folder, script_path)) != manifest[script_path]:
+        return script_path + " was modified"
+    except (IOError, OSError):
+      return script_path + " is missing"
+    return None
+  script_paths = sorted(manifest)
+  return [problem for problem in run_parallel(check_script, script_paths, 16) if problem != None]
+
+def verify_install_record(install_record, deep):
+  install_folder = install_record["install_folder"]
+  problems = [install_folder + "/" + file_name + " is missing" for file_name in ["license.bin", "config.txt"] if not os.path.isfile(install_folder + "/" + file_name)]
+  image_problem = verify_image(install_record["image"], install_record["container"])
+  if image_problem != None:
+    problems.append(image_problem)
+  problems += verify_scripts(install_folder, install_record["scripts"])
+  if deep == True and not problems:
+    write_log("+ " + install_folder + "/pbrun version\n")
+    version_check = probe_command([install_folder + "/pbrun", "version"])
+    write_log(version_check["output"])
+    if version_check["returncode"] != 0:
+      problems.append("pbrun version failed with exit code " + str(version_check["returncode"]))
+  return problems
+
+# The docker image installed by this run has to match a digest that does not
+# come from the installed image itself: the Id the image had right after the
+# registry pull, or the image cache, inventory or earlier pull digest it was
+# installed from.
+def verify_image_source(image_record):
+  if install_args.container != "docker":
+    return []
+  if expected_image.get("digest") == None:
+    return ["image " + image_record["ref"] + " was not pulled from " + get_release_full_name() + " and no digest is recorded for it"]
+  if image_record["digest"] != expected_image["digest"]:
+    return ["image " + image_record["ref"] + " is " + str(image_record["digest"]) + ", expected " + expected_image["digest"] + " from " + expected_image["source"]]
+  return []
+
+# Nodes activating a shared installation verify against the record of the node
+# that built it, which is independent of their own image already
+def verify_install(install_record, check_image_source):
+  with timeline.phase("verify") as verify_phase:
+    problems = verify_install_record(install_record, install_args.deep_verify)
+    if check_image_source == True:
+      problems = verify_image_source(install_record["image"]) + problems
+    if problems:
+      verify_phase["exit_code"] = 1
+      for problem in problems:
+        print(problem)
+      print("Installation did not verify. Exiting...")
+      InstallAbort()
+
+# --verify checks every installation recorded in the install location
+def verify_installations(install_args):
+  inventory = load_inventory(install_args.install_root)
+  if not inventory["releases"]:
+    print("No Parabricks installation recorded in " + install_args.install_root)
+    sys.exit(-1)
+  failed = False
+  for install_key in sorted(inventory["releases"]):
+    install_record = inventory["releases"][install_key]
+    start_time = time.time()
+    problems = verify_install_record(install_record, install_args.deep_verify)
+    description = install_record["release"] + " (" + install_record["container"] + ") in " + install_record["install_folder"]
+    if problems:
+      failed = True
+      print(description + ": FAILED")
+      for problem in problems:
+        print("  " + problem)
+    else:
+      print(description + ": OK, %d scripts verified in %.2f s" % (len(install_record["scripts"]), time.time() - start_time))
+  if failed == True:
+    sys.exit(-1)
+
+def update_inventory(install_folder, runCmd):
+  install_record = get_install_record(install_folder, runCmd)
+  superseded = []
+  try:
+    with locked_file(inventory_path(install_args.install_root) + ".lock"):
+      inventory = load_inventory(install_args.install_root)
+      if install_args.upgrade == True:
+        superseded = [inventory["releases"].pop(install_key) for install_key in sorted(inventory["releases"]) if inventory["releases"][install_key]["release"] != install_args.release and inventory["releases"][install_key]["container"] == install_args.container and inventory["releases"][install_key]["install_folder"] == install_folder]
+      inventory["releases"][get_inventory_key(install_args.container)] = install_record
+      write_json_atomic(inventory_path(install_args.install_root), inventory)
+  except (IOError, OSError) as exc:
+    write_log(str(exc) + "\n")
+    print("Could not update " + inventory_path(install_args.install_root) + ", --status and --uninstall will not know about this installation")
+  for install_record in superseded:
+    remove_superseded_image(install_record)
+
+# The upgraded installation no longer uses the image of the release it replaced.
+# Failing to remove it only wastes space, so it does not fail the upgrade.
+def remove_superseded_image(install_record):
+  if install_record["container"] != "docker" or install_record["image"]["ref"] == "parabricks/release:" + install_args.release:
+    return
+  image_ref = install_record["image"]["ref"]
+  print("Removing image of release " + install_record["release"] + ": " + image_ref)
+  if remove_docker_image_if_present(image_ref) == False:
+    print("Could not remove " + image_ref + ", remove it with docker rmi " + image_ref)
+
+def remove_docker_image_if_present(image_ref):
+  def remove_with_engine(engine):
+    try:
+      engine.remove_image(image_ref)
+      return 0
+    except DockerEngineError as exc:
+      write_log(str(exc) + "\n")
+      return 1
+  def remove_with_cli():
+    write_log("+ docker rmi " + image_ref + "\n")
+    return subprocess.call(["docker", "rmi", image_ref], stdout = log_file, stderr = log_file)
+  return call_docker(remove_with_engine, remove_with_cli) == 0
+
+def print_status(install_args):
+  inventory = load_inventory(install_args.install_root)
+  if not inventory["releases"]:
+    print("No Parabricks installation recorded in " + install_args.install_root)
+    return
+  for install_key in sorted(inventory["releases"]):
+    install_record = inventory["releases"][install_key]
+    image_record = install_record["image"]
+    print("====================================")
+    print("Release:                " + install_record["release"])
+    print("Install Directory:      " + install_record["install_folder"])
+    print("Install Container Type: " + install_record["container"] + " (" + install_record["run_command"] + ")")
+    print("Install Architecture:   " + install_record["arch"])
+    print("Image:                  " + image_record.get("ref", image_record.get("path")) + " (" + format_size(image_record["size"]) + ")")
+    print("Image Digest:           " + str(image_record["digest"]))
+    print("Scripts:                " + str(len(install_record["scripts"])) + " files")
+    print("Symlink:                " + str(install_record["symlink"]))
+    print("Installed:              " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(install_record["installed_at"])) + " on " + install_record["host"])
+    if len(install_record.get("hosts", [])) > 1:
+      print("Activated On:           " + " ".join(install_record["hosts"]))
+  print("====================================")
+
+# --upgrade builds the new release in a folder next to the current installation,
+# reusing the image of the same release if it is already there. Once the new
+# folder is verified it is exchanged with the current one in a single
+# renameat2(RENAME_EXCHANGE). Where that is not available (not Linux, old
+# kernels or glibc, some network file systems) it falls back to two renames,
+# and the install folder is missing for a moment. If the installer dies in
+# that moment, recover_upgrade_folder() restores the old folder on the next run.
+def prepare_upgrade_folder(build_folder, install_folder):
+  check_install_folder(build_folder)
+  for image_name in ["parabricks-release-" + install_args.release + ".sif", "parabricks-release-" + install_args.release + ".simg"]:
+    if os.path.isfile(install_folder + "/" + image_name):
+      link_or_copy(install_folder + "/" + image_name, build_folder + "/" + image_name)
+
+# Swaps the two folders in one step. Returns False if the C library, the kernel
+# or the file system does not support it.
+def exchange_folders(first_folder, second_folder):
+  if ctypes == None:
+    return False
+  try:
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), "renameat2", None)
+  except OSError:
+    return False
+  if renameat2 == None:
+    return False
+  renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+  if renameat2(AT_FDCWD, first_folder.encode("utf-8"), AT_FDCWD, second_folder.encode("utf-8"), RENAME_EXCHANGE) == 0:
+    return True
+  error_number = ctypes.get_errno()
+  if error_number in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+    write_log("renameat2 not supported for " + second_folder + " (" + os.strerror(error_number) + "), using two renames\n")
+    return False
+  raise OSError(error_number, os.strerror(error_number), second_folder)
+
+def swap_upgrade_folder(build_folder, install_folder):
+  retired_folder = build_folder + ".old"
+  try:
+    if os.path.exists(install_folder) and exchange_folders(build_folder, install_folder):
+      # The build folder now holds the previous installation
+      shutil.rmtree(build_folder, True)
+      return
+    if os.path.exists(install_folder):
+      os.rename(install_folder, retired_folder)
+    os.rename(build_folder, install_folder)
+  except OSError as exc:
+    write_log(str(exc) + "\n")
+    if os.path.exists(retired_folder) and not os.path.exists(install_folder):
+      os.rename(retired_folder, install_folder)
+    print("Could not move the upgraded installation into " + install_folder)
+    InstallAbort()
+  shutil.rmtree(retired_folder, True)
+
+# Puts back the installation an interrupted two-rename swap had already moved
+# aside, and removes one that was left behind after the swap completed
+def recover_upgrade_folder(install_root):
+  try:
+    retired_folders = [install_root + "/" + folder_name for folder_name in os.listdir(install_root)
+                       if folder_name.startswith(".parabricks-upgrade-") and folder_name.endswith(".old")]
+  except OSError:
+    return
+  retired_folders.sort(key=os.path.getmtime)
+  install_folder = install_root + "/parabricks"
+  if retired_folders and not os.path.exists(install_folder):
+    print("Restoring " + install_folder + " from interrupted upgrade " + retired_folders[-1] + "\n")
+    try:
+      os.rename(retired_folders.pop(), install_folder)
+    except OSError as exc:
+      write_log(str(exc) + "\n")
+      return
+  for retired_folder in retired_folders:
+    write_log("Removing " + retired_folder + " left by an earlier upgrade\n")
+    shutil.rmtree(retired_folder, True)
+
+# runCmd is the preflight result if the preflight checks already ran
+def install_parabricks(script_dir, runCmd=None):
   install_folder = install_args.install_location #Easy access the same variable
   if os.path.isfile(script_dir + "/license.bin") == False:
-    print ("License file " + scipt_dir + "/license.bin" + " does not exist. Exiting...")
+    print ("License file " + script_dir + "/license.bin" + " does not exist. Exiting...")
     InstallAbort()
 
-  check_install_folder(install_folder)
-  if os.path.abspath(script_dir + "/license.bin") != os.path.abspath(install_folder + "/license.bin"):
-    shutil.copy(script_dir + "/license.bin", install_folder + "/license.bin" )
+  build_folder = install_folder
+  created_install_folder = not os.path.exists(build_folder)
+  if install_args.upgrade == True:
+    try:
+      build_folder = tempfile.mkdtemp(prefix=".parabricks-upgrade-", dir=install_args.install_root)
+      os.chmod(build_folder, 0o755)
+    except OSError:
+      print("\nPlease check you have write permissions in " + install_args.install_root)
+      InstallAbort()
+    install_args.install_location = build_folder
+    created_install_folder = True
+  def remove_install_folder(results):
+    if created_install_folder == True:
+      shutil.rmtree(build_folder, True)
+
+  prepare_folder = lambda results: check_install_folder(build_folder)
+  if install_args.upgrade == True:
+    prepare_folder = lambda results: prepare_upgrade_folder(build_folder, install_folder)
+  steps = [
+    InstallStep("preflight", lambda results: runCmd or check_requirements(install_args.cpu_only)),
+    InstallStep("install folder", prepare_folder, rollback=remove_install_folder),
+    InstallStep("image cache", lambda results: check_image_cache()),
+    InstallStep("license", lambda results: copy_license(script_dir, build_folder), ["install folder"],
+                rollback=lambda results: results["license"] == True and remove_file(build_folder + "/license.bin")),
+    InstallStep("config", lambda results: write_config(build_folder, results["preflight"]), ["preflight", "install folder"],
+                rollback=lambda results: remove_file(build_folder + "/config.txt")),
+    InstallStep("image", lambda results: install_image(results["preflight"]), ["preflight", "install folder", "image cache"],
+                rollback=lambda results: results["image"] == True and remove_installed_image(build_folder)),
+    InstallStep("scripts", lambda results: install_scripts(build_folder, results["preflight"]), ["image"]),
+    InstallStep("verify", lambda results: verify_install(get_install_record(build_folder, results["preflight"]), True), ["scripts", "license", "config"]),
+  ]
+  inventory_deps = ["verify"]
+  if install_args.upgrade == True:
+    steps.append(InstallStep("swap", lambda results: swap_upgrade_folder(build_folder, install_folder), ["verify"]))
+    inventory_deps = ["swap"]
+  steps.append(InstallStep("inventory", lambda results: update_inventory(install_folder, results["preflight"]), inventory_deps))
+  run_install_steps(steps)
+  print("Installation successful")
+
+def run_install_steps(steps):
+  scheduler = StepScheduler(steps)
+  succeeded = scheduler.run()
+  write_log("Critical path: " + scheduler.format_critical_path() + "\n")
+  if install_args.critical_path == True:
+    print("Critical path: " + scheduler.format_critical_path() + "\n")
+  if succeeded == False:
+    InstallAbort()
+
+# Returns the inventory record of this release if another node already built it
+# in the shared install folder. config.txt is shared by all nodes, so a node
+# whose preflight result differs from the one the installation was built for
+# (e.g. singularity 3.x for a 2.x .simg install) cannot activate it. Without
+# runCmd (before the preflight checks ran) this is not checked.
+def get_shared_install_record(runCmd=None):
+  install_folder = install_args.install_location
+  install_record = load_inventory(install_args.install_root)["releases"].get(get_inventory_key(install_args.container))
+  if install_args.upgrade == True or install_record == None:
+    return None
+  if install_record["install_folder"] != install_folder or install_record["container"] != install_args.container:
+    return None
+  if not os.path.isfile(install_folder + "/pbrun") or not os.path.isfile(install_folder + "/license.bin"):
+    return None
+  if install_args.container != "docker" and not os.path.isfile(install_record["image"]["path"]):
+    return None
+  if runCmd != None and (install_record["run_command"] != runCmd or install_record["arch"] != install_args.arch):
+    print("Release " + install_args.release + " in " + install_folder + " was installed by " + install_record["host"] + " for " + install_record["run_command"] + " on " + install_record["arch"])
+    print("This node needs " + runCmd + " on " + install_args.arch + " and cannot use the shared installation. Install it into a different location. Exiting...")
+    InstallAbort()
+  return install_record
+
+def activate_node(install_folder):
+  create_pbrun_symlink()
+  try:
+    with locked_file(inventory_path(install_args.install_root) + ".lock"):
+      inventory = load_inventory(install_args.install_root)
+      install_record = inventory["releases"][get_inventory_key(install_args.container)]
+      if socket.gethostname() not in install_record.setdefault("hosts", []):
+        install_record["hosts"].append(socket.gethostname())
+        write_json_atomic(inventory_path(install_args.install_root), inventory)
+  except (IOError, OSError, KeyError) as exc:
+    write_log("Could not record activation in the inventory: " + str(exc) + "\n")
+
+# With --shared, nodes installing into the same (e.g. NFS) install location take
+# turns on a lock in the install root. The first node builds the installation,
+# the others wait for it and then only do the per-node work: configuration,
+# symlink and, for docker, pulling the image into the node's own daemon.
+def install_parabricks_shared(script_dir):
+  install_folder = install_args.install_location
+  try:
+    if not os.path.isdir(install_args.install_root):
+      os.makedirs(install_args.install_root)
+  except OSError:
+    if not os.path.isdir(install_args.install_root):
+      print("\nPlease check you have permissions to create " + install_args.install_root)
+      InstallAbort()
+  runCmd = check_requirements(install_args.cpu_only)
+  with locked_file(install_args.install_root + "/.parabricks-install.lock", "Waiting for another node installing into " + install_args.install_root + "\n"):
+    install_record = get_shared_install_record(runCmd)
+    if install_record == None:
+      install_parabricks(script_dir, runCmd)
+      return
 
-  install_image(runCmd)
-  install_scripts(install_folder, runCmd)
-  run_and_return([install_folder + "/pbrun", "version" ], "Could not test version. Exiting...\n", False, False)
-  with open(install_folder + "/config.txt", "w") as f:
-    f.write(runCmd + "\n")
-    f.write(install_args.arch + "\n")
+  print("Release " + install_args.release + " was already installed in " + install_folder + " by " + install_record["host"] + ", activating it on this node\n")
+  steps = [
+    InstallStep("preflight", lambda results: runCmd),
+    InstallStep("config", lambda results: write_config(install_folder, results["preflight"]), ["preflight"]),
+  ]
+  activation_deps = ["config"]
+  if install_args.container == "docker":
+    steps += [
+      InstallStep("image cache", lambda results: check_image_cache()),
+      InstallStep("image", lambda results: install_image(results["preflight"]), ["preflight", "image cache"]),
+      InstallStep("verify", lambda results: verify_install(install_record, False), ["image", "config"]),
+    ]
+    activation_deps.append("verify")
+  steps.append(InstallStep("activation", lambda results: activate_node(install_folder), activation_deps))
+  run_install_steps(steps)
   print("Installation successful")
 
+# Fleet mode runs installer.py --force on every host of a host list. The transport
+# decides how the installer is started on a host, the local transport runs it as
+# a subprocess on this machine and is meant for testing.
+class LocalTransport(object):
+  def command_line(self, host, installer_args):
+    return [sys.executable, os.path.realpath(__file__)] + installer_args
+
+class SshTransport(object):
+  def command_line(self, host, installer_args):
+    remote_cmd = [os.path.basename(sys.executable), os.path.realpath(__file__)] + installer_args
+    return ["ssh", "-o", "BatchMode=yes", host, " ".join(shell_quote(arg) for arg in remote_cmd)]
+
+FLEET_TRANSPORTS = {"local": LocalTransport, "ssh": SshTransport}
+
+def read_fleet_hosts(host_file):
+  hosts = []
+  try:
+    with open(host_file, "r") as hosts_file:
+      for host_line in hosts_file:
+        host = host_line.split("#", 1)[0].strip()
+        if host != "" and host not in hosts:
+          hosts.append(host)
+  except (IOError, OSError):
+    print("Could not read host list " + host_file)
+    InstallAbort()
+  if not hosts:
+    print("No hosts in " + host_file)
+    InstallAbort()
+  return hosts
+
+# The options of this run without the fleet options, as passed to every host
+def get_fleet_installer_args():
+  installer_args = []
+  skip_value = False
+  for arg in sys.argv[1:]:
+    if skip_value == True:
+      skip_value = False
+      continue
+    if arg.split("=", 1)[0] in FLEET_OPTIONS:
+      skip_value = "=" not in arg
+      continue
+    installer_args.append(arg)
+  if install_args.symlink == True and "--symlink" not in installer_args:
+    installer_args.append("--symlink")
+  return installer_args + ["--force", "--fleet-node"]
+
+def write_fleet_log(host, log_text):
+  with log_lock:
+    log_file.write("".join("[" + host + "] " + log_line for log_line in log_text.splitlines(True)))
+    log_file.flush()
+
+# Installs on one host, retrying failed attempts. The host prints its install
+# timeline on a PB_TIMELINE line, everything else goes to the fleet log.
+def run_fleet_node(transport, host, installer_args):
+  cmd_line = transport.command_line(host, [arg.replace("{host}", host) for arg in installer_args])
+  newEnviron = os.environ.copy()
+  newEnviron["PYTHONUNBUFFERED"] = "1"
+  result = {"host": host, "attempts": 0, "exit_code": None, "seconds": 0.0, "timeline": None}
+  while result["attempts"] <= install_args.fleet_retries:
+    result["attempts"] += 1
+    start_time = time.time()
+    write_fleet_log(host, "+ " + " ".join(cmd_line) + "\n")
+    try:
+      with open(os.devnull, "r") as devnull:
+        cmd_proc = subprocess.Popen(cmd_line, stdin = devnull, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env=newEnviron, universal_newlines=True)
+    except OSError as exc:
+      write_fleet_log(host, str(exc) + "\n")
+      result["exit_code"] = 127
+      break
+    timer = None
+    if install_args.fleet_timeout != None:
+      timer = threading.Timer(install_args.fleet_timeout, cmd_proc.kill)
+      timer.start()
+    for output_line in iter(cmd_proc.stdout.readline, ""):
+      if output_line.startswith("PB_TIMELINE "):
+        try:
+          result["timeline"] = json.loads(output_line[len("PB_TIMELINE "):])
+        except ValueError:
+          write_fleet_log(host, output_line)
+      else:
+        write_fleet_log(host, output_line)
+    cmd_proc.stdout.close()
+    result["exit_code"] = cmd_proc.wait()
+    if timer != None:
+      timer.cancel()
+    result["seconds"] += time.time() - start_time
+    if result["exit_code"] == 0:
+      break
+    if result["attempts"] <= install_args.fleet_retries:
+      print(host + ": install failed with exit code " + str(result["exit_code"]) + ", retrying")
+  print(host + ": " + ("installed" if result["exit_code"] == 0 else "failed") + " after %.1f s" % result["seconds"])
+  return result
+
+def format_fleet_matrix(results):
+  lines = ["%-24s %-8s %8s %9s" % ("Host", "Result", "Attempts", "Total") + "".join(" %18s" % phase_name for phase_name in FLEET_PHASES)]
+  for result in results:
+    phase_seconds = {}
+    for record in (result["timeline"] or {}).get("phases", []):
+      phase_seconds[record["name"]] = phase_seconds.get(record["name"], 0) + record["seconds"]
+    line = "%-24s %-8s %8d %8.1fs" % (result["host"], "ok" if result["exit_code"] == 0 else "FAILED", result["attempts"], result["seconds"])
+    for phase_name in FLEET_PHASES:
+      if phase_name in phase_seconds:
+        line += " %17.1fs" % phase_seconds[phase_name]
+      else:
+        line += " %18s" % "-"
+    lines.append(line)
+  return "\n".join(lines)
+
+# With a shared --image-cache the first host pulls the image into the cache on
+# its own, so the other hosts load it from there instead of all pulling at once.
+def run_fleet():
+  hosts = read_fleet_hosts(install_args.fleet)
+  transport = FLEET_TRANSPORTS[install_args.fleet_transport]()
+  installer_args = get_fleet_installer_args()
+  start_time = time.time()
+  results = []
+  pending = hosts
+  if install_args.image_cache != None and len(hosts) > 1:
+    print("Installing on " + hosts[0] + " first to fill the image cache " + install_args.image_cache + "\n")
+    results.append(run_fleet_node(transport, hosts[0], installer_args))
+    pending = hosts[1:]
+    if results[0]["exit_code"] != 0:
+      print("Seed host " + hosts[0] + " failed, the other hosts pull the image themselves\n")
+  print("Installing on " + str(len(pending)) + " hosts, " + str(install_args.fleet_workers) + " at a time\n")
+  results += run_parallel(lambda host: run_fleet_node(transport, host, installer_args), pending, install_args.fleet_workers)
+
+  failed_hosts = [result["host"] for result in results if result["exit_code"] != 0]
+  print("\n" + format_fleet_matrix(results) + "\n")
+  print("%d of %d hosts installed in %.1f s" % (len(results) - len(failed_hosts), len(results), time.time() - start_time))
+  report_path = log_path.replace("pb_install_log_", "pb_fleet_report_").replace(".txt", ".json")
+  write_json_atomic(report_path, {"seconds": time.time() - start_time, "hosts": results})
+  print("Fleet report written to " + report_path)
+  if failed_hosts:
+    print("Installation failed on: " + " ".join(failed_hosts) + ". See " + log_path)
+    sys.exit(-1)
+
 if __name__ == '__main__':
   currentDir = os.getcwd()
   scriptDir = os.path.dirname(os.path.realpath(__file__))
   install_args = get_install_args()
 
-  with open("/tmp/pb_install_log_" + str(time.time()) + ".txt", "w") as log_file:
-    if install_args.uninstall == True:
+  log_path = "/tmp/pb_install_log_" + str(time.time()) + ".txt"
+  with open(log_path, "w") as log_file:
+    if install_args.fleet == None:
+      recover_upgrade_folder(install_args.install_root)
+    if install_args.status == True:
+      print_status(install_args)
+    elif install_args.verify == True:
+      verify_installations(install_args)
+    elif install_args.uninstall == True:
       uninstall_pbrun(install_args)
+    elif install_args.fleet != None:
+      GetEULAAgreement(scriptDir, install_args)
+      print_selection(install_args)
+      run_fleet()
     else:
+      start_prefetch()
       GetEULAAgreement(scriptDir, install_args)
       print_selection(install_args)
-      install_parabricks(scriptDir)
+      try:
+        if install_args.shared == True:
+          install_parabricks_shared(scriptDir)
+        else:
+          install_parabricks(scriptDir)
+      finally:
+        timeline.write(log_path, install_args.chrome_trace)
 
@@ -0,0 +1,252 @@
+import argparse
+import base64
+import io
+import json
+import os
+import shutil
+import socket
+import sys
+import tarfile
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import installer
+
+try:
+  import socketserver
+  from http.server import BaseHTTPRequestHandler
+  from urllib.parse import urlparse, parse_qs
+except ImportError:
+  import SocketServer as socketserver
+  from BaseHTTPServer import BaseHTTPRequestHandler
+  from urlparse import urlparse, parse_qs
+
+IMAGE_REF = "nvcr.io/hpc/parabricks:v2.5.0"
+IMAGE_ID = "sha256:" + "ab" * 32
+
+def build_release_archive():
+  archive = io.BytesIO()
+  with tarfile.open(fileobj=archive, mode="w") as release_tar:
+    member = tarfile.TarInfo("release-v2.5.0.tar.gz")
+    member.size = 100000
+    release_tar.addfile(member, io.BytesIO(b"p" * member.size))
+  return archive.getvalue()
+
+# Answers the Docker Engine API calls the installer makes, keeping images and
+# containers in memory like dockerd does
+class FakeEngineHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def send_json(self, status, data):
+    body = json.dumps(data).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def send_chunked(self, content_type, chunks):
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Transfer-Encoding", "chunked")
+    self.end_headers()
+    for chunk in chunks:
+      self.wfile.write(("%x\r\n" % len(chunk)).encode("ascii") + chunk + b"\r\n")
+    self.wfile.write(b"0\r\n\r\n")
+
+  def handle_request(self, method):
+    engine = self.server
+    url = urlparse(self.path)
+    params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    engine.requests.append((method, url.path, params))
+    if engine.drop_after_response == True:
+      engine.drop_after_response = False
+      self.close_connection = True
+    if method == "GET" and url.path == "/_ping":
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain")
+      self.send_header("Content-Length", "2")
+      self.end_headers()
+      self.wfile.write(b"OK")
+    elif method == "GET" and url.path == "/images/json":
+      filters = json.loads(params.get("filters", "{}"))
+      images = [image for ref, image in sorted(engine.images.items()) if ref in filters.get("reference", [ref])]
+      self.send_json(200, [{"Id": image["Id"], "RepoTags": image["RepoTags"]} for image in images])
+    elif method == "GET" and url.path.startswith("/images/") and url.path.endswith("/json"):
+      image_ref = url.path[len("/images/"):-len("/json")]
+      if image_ref not in engine.images:
+        self.send_json(404, {"message": "No such image: " + image_ref})
+      else:
+        self.send_json(200, engine.images[image_ref])
+    elif method == "POST" and url.path == "/images/create":
+      if self.headers.get("X-Registry-Auth") != None:
+        engine.auth.append(json.loads(base64.urlsafe_b64decode(self.headers["X-Registry-Auth"].encode("ascii")).decode("utf-8")))
+      image_ref = params["fromImage"] + ":" + params["tag"]
+      engine.images[image_ref] = {"Id": IMAGE_ID, "RepoTags": [image_ref], "RepoDigests": [params["fromImage"] + "@sha256:" + "cd" * 32], "Size": 1000}
+      messages = [{"status": "Pulling from " + params["fromImage"]},
+                  {"id": "0123456789ab", "status": "Downloading", "progressDetail": {"current": 500, "total": 1000}},
+                  {"id": "0123456789ab", "status": "Download complete"},
+                  {"status": "Status: Downloaded newer image for " + image_ref}]
+      self.send_chunked("application/json", [json.dumps(message).encode("utf-8") + b"\r\n" for message in messages])
+    elif method == "POST" and url.path.startswith("/images/") and url.path.endswith("/tag"):
+      image = engine.images[url.path[len("/images/"):-len("/tag")]]
+      target_ref = params["repo"] + ":" + params["tag"]
+      image["RepoTags"].append(target_ref)
+      engine.images[target_ref] = image
+      self.send_response(201)
+      self.send_header("Content-Length", "0")
+      self.end_headers()
+    elif method == "DELETE" and url.path.startswith("/images/"):
+      image_ref = url.path[len("/images/"):]
+      if image_ref not in engine.images:
+        self.send_json(404, {"message": "No such image: " + image_ref})
+        return
+      # Removing the last tag of a repository also drops its digest references
+      image = engine.images.pop(image_ref)
+      image["RepoTags"].remove(image_ref)
+      repository = image_ref.rsplit(":", 1)[0]
+      if not any(repo_tag.rsplit(":", 1)[0] == repository for repo_tag in image["RepoTags"]):
+        image["RepoDigests"] = [repo_digest for repo_digest in image["RepoDigests"] if not repo_digest.startswith(repository + "@")]
+      self.send_json(200, [{"Untagged": image_ref}])
+    elif method == "POST" and url.path == "/containers/create":
+      engine.containers["c0ffee"] = json.loads(body.decode("utf-8"))
+      self.send_json(201, {"Id": "c0ffee", "Warnings": []})
+    elif method == "GET" and url.path == "/containers/c0ffee/archive":
+      archive = build_release_archive()
+      self.send_chunked("application/x-tar", [archive[offset:offset + 16384] for offset in range(0, len(archive), 16384)])
+    elif method == "DELETE" and url.path == "/containers/c0ffee":
+      del engine.containers["c0ffee"]
+      self.send_response(204)
+      self.end_headers()
+    else:
+      self.send_json(404, {"message": "page not found"})
+
+  def do_GET(self):
+    self.handle_request("GET")
+
+  def do_POST(self):
+    self.handle_request("POST")
+
+  def do_DELETE(self):
+    self.handle_request("DELETE")
+
+class FakeEngineServer(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socket_path):
+    socketserver.ThreadingUnixStreamServer.__init__(self, socket_path, FakeEngineHandler)
+    self.requests = []
+    self.auth = []
+    self.images = {}
+    self.containers = {}
+    self.connections = 0
+    self.drop_after_response = False
+
+  def process_request(self, request, client_address):
+    self.connections += 1
+    socketserver.ThreadingUnixStreamServer.process_request(self, request, client_address)
+
+class DockerEngineClientTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.socket_path = self.temp_dir + "/docker.sock"
+    self.server = FakeEngineServer(self.socket_path)
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+    installer.log_file = open(os.devnull, "w")
+    installer.install_args = argparse.Namespace(docker_cli=False)
+    installer.docker_engine = False
+    self.engine = installer.DockerEngineClient(self.socket_path)
+
+  def tearDown(self):
+    self.engine.close()
+    self.server.shutdown()
+    self.server.server_close()
+    installer.log_file.close()
+    installer.docker_engine = False
+    shutil.rmtree(self.temp_dir)
+
+  def test_install_calls(self):
+    self.assertTrue(self.engine.ping())
+    self.assertEqual(self.engine.inspect_image(IMAGE_REF), None)
+
+    self.engine.pull_image(IMAGE_REF, {"username": "pbuser", "password": "token"})
+    self.assertEqual(self.server.auth, [{"username": "pbuser", "password": "token"}])
+    self.assertEqual(self.engine.inspect_image(IMAGE_REF)["Id"], IMAGE_ID)
+
+    self.engine.tag_image(IMAGE_REF, "parabricks/release:v2.5.0")
+    self.assertEqual([image["RepoTags"] for image in self.engine.list_images({"reference": ["parabricks/release:v2.5.0"]})],
+                     [[IMAGE_REF, "parabricks/release:v2.5.0"]])
+
+    container_id = self.engine.create_container("parabricks/release:v2.5.0", ["true"])
+    self.assertEqual(self.server.containers[container_id], {"Image": "parabricks/release:v2.5.0", "Cmd": ["true"]})
+    connection, response = self.engine.get_archive(container_id, "/parabricks/release-v2.5.0.tar.gz")
+    self.assertEqual(response.read(), build_release_archive())
+    self.engine.release(connection, response)
+    self.engine.remove_container(container_id)
+    self.assertEqual(self.server.containers, {})
+
+    self.engine.remove_image(IMAGE_REF)
+    self.assertEqual(self.engine.inspect_image(IMAGE_REF), None)
+    self.assertEqual(self.engine.inspect_image("parabricks/release:v2.5.0")["RepoDigests"], [])
+    with self.assertRaises(installer.DockerEngineError) as raised:
+      self.engine.remove_image(IMAGE_REF)
+    self.assertEqual(raised.exception.status, 404)
+
+    # Every call above went over one pooled keep-alive connection
+    self.assertEqual(self.server.connections, 1)
+
+  def test_pull_progress(self):
+    progress = installer.PullProgress()
+    progress.interactive = False
+    self.engine.pull_image(IMAGE_REF, None, progress)
+    self.assertEqual(self.server.auth, [])
+    self.assertEqual(progress.layers, {"0123456789ab": [1000, 1000]})
+    self.assertEqual(self.server.requests[-1], ("POST", "/images/create", {"fromImage": "nvcr.io/hpc/parabricks", "tag": "v2.5.0"}))
+
+  def test_stale_pooled_connection(self):
+    self.server.drop_after_response = True
+    self.assertTrue(self.engine.ping())
+    self.assertEqual(len(self.engine.idle_connections), 1)
+    self.assertEqual(self.engine.inspect_image(IMAGE_REF), None)
+    self.assertEqual(self.server.connections, 2)
+
+  def test_get_docker_engine(self):
+    os.environ["DOCKER_HOST"] = "unix://" + self.socket_path
+    try:
+      self.assertNotEqual(installer.get_docker_engine(), None)
+      self.assertEqual(installer.get_docker_engine().socket_path, self.socket_path)
+      installer.docker_engine.close()
+
+      installer.docker_engine = False
+      installer.install_args.docker_cli = True
+      self.assertEqual(installer.get_docker_engine(), None)
+    finally:
+      del os.environ["DOCKER_HOST"]
+
+  def test_fallback_to_cli(self):
+    unbound_path = self.temp_dir + "/stale.sock"
+    unbound_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    unbound_socket.bind(unbound_path)
+    unbound_socket.close()
+    os.environ["DOCKER_HOST"] = "unix://" + unbound_path
+    try:
+      self.assertEqual(installer.get_docker_engine(), None)
+    finally:
+      del os.environ["DOCKER_HOST"]
+
+    # The socket goes away in the middle of an install
+    installer.docker_engine = installer.DockerEngineClient(unbound_path)
+    self.assertEqual(installer.call_docker(lambda engine: engine.inspect_image(IMAGE_REF), lambda: "cli"), "cli")
+    self.assertEqual(installer.docker_engine, None)
+    self.assertEqual(installer.call_docker(lambda engine: self.fail("engine used after fallback"), lambda: "cli"), "cli")
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import installer
+from test_docker_engine import FakeEngineServer, IMAGE_ID, IMAGE_REF
+
+# Runs the docker image install against the fake Engine API, which like dockerd
+# drops the registry digest of the image when the registry reference is untagged
+class DockerImageVerificationTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.server = FakeEngineServer(self.temp_dir + "/docker.sock")
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+    os.environ["DOCKER_HOST"] = "unix://" + self.temp_dir + "/docker.sock"
+    self.pulled_images_file = installer.PULLED_IMAGES_FILE
+    installer.PULLED_IMAGES_FILE = self.temp_dir + "/home/docker_images.json"
+    installer.log_file = open(os.devnull, "w")
+    installer.install_args = argparse.Namespace(container="docker", release="v2.5.0", arch="x86_64", ngc=True, access_token="",
+                                                upgrade=False, install_root=self.temp_dir, image_cache=None, docker_cli=False)
+    installer.docker_engine = False
+    installer.prefetch_job = None
+
+  def tearDown(self):
+    if installer.docker_engine:
+      installer.docker_engine.close()
+    installer.docker_engine = False
+    installer.PULLED_IMAGES_FILE = self.pulled_images_file
+    installer.expected_image.clear()
+    installer.log_file.close()
+    del os.environ["DOCKER_HOST"]
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.temp_dir)
+
+  def install_image(self):
+    self.assertTrue(installer.install_docker_image())
+    return installer.get_image_record(self.temp_dir + "/parabricks", None)
+
+  def test_pulled_image_verifies(self):
+    image_record = self.install_image()
+    self.assertEqual(image_record["digest"], IMAGE_ID)
+    self.assertEqual(image_record["repo_digests"], [])
+    self.assertEqual(installer.verify_image_source(image_record), [])
+
+  def test_replaced_image_fails(self):
+    image_record = self.install_image()
+    self.server.images["parabricks/release:v2.5.0"]["Id"] = "sha256:" + "ef" * 32
+    image_record = installer.get_image_record(self.temp_dir + "/parabricks", None)
+    self.assertEqual(len(installer.verify_image_source(image_record)), 1)
+
+  def test_image_without_expected_digest_fails(self):
+    image_record = self.install_image()
+    installer.expected_image.clear()
+    self.assertEqual(len(installer.verify_image_source(image_record)), 1)
+
+  def test_upgrade_reuse_verifies(self):
+    self.install_image()
+    installer.install_args.upgrade = True
+    self.assertFalse(installer.install_docker_image())
+    self.assertEqual(installer.expected_image["digest"], IMAGE_ID)
+    self.assertEqual(installer.verify_image_source(installer.get_image_record(self.temp_dir + "/parabricks", None)), [])
+
+  def test_local_image_found_after_untag(self):
+    self.install_image()
+    self.assertEqual(installer.find_local_docker_image(), {"format": "docker-daemon", "ref": "parabricks/release:v2.5.0", "digest": IMAGE_ID})
+    self.assertEqual(installer.load_pulled_docker_images()[IMAGE_REF]["digest"], IMAGE_ID)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,223 @@
+import io
+import os
+import struct
+import sys
+import unittest
+import uuid
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import installer
+
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+BLOCK_SIZE = 4096
+METADATA_SIZE = 8192
+UNCOMPRESSED_BLOCK = 0x1000000
+NO_FRAGMENT = 0xFFFFFFFF
+
+def gzip_compress(data):
+  return zlib.compress(data)
+
+def xz_compress(data):
+  return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32)
+
+# Writes a squashfs 4.0 image the way mksquashfs lays it out: compressed data
+# blocks (stored raw when compression does not help), file tails packed into a
+# shared fragment block, and compressed inode, directory and fragment tables.
+# The tables have to fit in one metadata block, which keeps every inode and
+# directory reference in block 0.
+def build_squashfs(files, compression_id, compress, extended):
+  tree = {}
+  for path, data in files.items():
+    parts = path.strip("/").split("/")
+    node = tree
+    for part in parts[:-1]:
+      node = node.setdefault(part, {})
+    node[parts[-1]] = data
+
+  image = io.BytesIO()
+  image.write(b"\0" * 96)
+  fragment_block = bytearray()
+  inodes = []
+
+  def store_block(data):
+    compressed = compress(data)
+    if len(compressed) >= len(data):
+      image.write(data)
+      return len(data) | UNCOMPRESSED_BLOCK
+    image.write(compressed)
+    return len(compressed)
+
+  def add_file(data):
+    blocks_start = image.tell()
+    full_blocks = len(data) // BLOCK_SIZE
+    block_sizes = [store_block(data[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE]) for i in range(full_blocks)]
+    fragment_index, fragment_offset = NO_FRAGMENT, 0
+    if len(data) % BLOCK_SIZE:
+      fragment_index, fragment_offset = 0, len(fragment_block)
+      fragment_block.extend(data[full_blocks * BLOCK_SIZE:])
+    inodes.append({"kind": "file", "blocks_start": blocks_start, "size": len(data), "block_sizes": block_sizes,
+                   "fragment_index": fragment_index, "fragment_offset": fragment_offset})
+    return len(inodes) - 1
+
+  def add_directory(node):
+    children = []
+    for name in sorted(node):
+      if isinstance(node[name], dict):
+        children.append((name, add_directory(node[name])))
+      else:
+        children.append((name, add_file(node[name])))
+    inodes.append({"kind": "dir", "children": children})
+    return len(inodes) - 1
+
+  root = add_directory(tree)
+  fragment_entries = b""
+  if fragment_block:
+    fragment_entries = struct.pack("<QII", image.tell(), store_block(bytes(fragment_block)), 0)
+
+  def inode_size(inode):
+    if inode["kind"] == "dir":
+      return 40 if extended else 32
+    return (56 if extended else 32) + 4 * len(inode["block_sizes"])
+  inode_offsets = []
+  position = 0
+  for inode in inodes:
+    inode_offsets.append(position)
+    position += inode_size(inode)
+
+  directory_data = b""
+  listing_offsets = {}
+  for index, inode in enumerate(inodes):
+    if inode["kind"] != "dir":
+      continue
+    listing_offsets[index] = len(directory_data)
+    listing = b""
+    if inode["children"]:
+      first_child = inode["children"][0][1]
+      listing += struct.pack("<IIi", len(inode["children"]) - 1, 0, first_child + 1)
+      for name, child in inode["children"]:
+        encoded_name = name.encode()
+        listing += struct.pack("<HhHH", inode_offsets[child], child - first_child, 1 if inodes[child]["kind"] == "dir" else 2, len(encoded_name) - 1) + encoded_name
+    inode["listing_size"] = len(listing)
+    directory_data += listing
+
+  inode_data = b""
+  for index, inode in enumerate(inodes):
+    if inode["kind"] == "dir" and extended:
+      inode_data += struct.pack("<HHHHII", 8, 0o755, 0, 0, 0, index + 1)
+      inode_data += struct.pack("<IIIIHHI", 2, inode["listing_size"] + 3, 0, 0, 0, listing_offsets[index], NO_FRAGMENT)
+    elif inode["kind"] == "dir":
+      inode_data += struct.pack("<HHHHII", 1, 0o755, 0, 0, 0, index + 1)
+      inode_data += struct.pack("<IIHHI", 0, 2, inode["listing_size"] + 3, listing_offsets[index], 0)
+    elif extended:
+      inode_data += struct.pack("<HHHHII", 9, 0o644, 0, 0, 0, index + 1)
+      inode_data += struct.pack("<QQQIIII", inode["blocks_start"], inode["size"], 0, 1, inode["fragment_index"], inode["fragment_offset"], NO_FRAGMENT)
+      inode_data += struct.pack("<%dI" % len(inode["block_sizes"]), *inode["block_sizes"])
+    else:
+      inode_data += struct.pack("<HHHHII", 2, 0o644, 0, 0, 0, index + 1)
+      inode_data += struct.pack("<IIII", inode["blocks_start"], inode["fragment_index"], inode["fragment_offset"], inode["size"])
+      inode_data += struct.pack("<%dI" % len(inode["block_sizes"]), *inode["block_sizes"])
+
+  def metadata_block(data):
+    assert len(data) <= METADATA_SIZE
+    compressed = compress(data)
+    if len(compressed) >= len(data):
+      return struct.pack("<H", len(data) | 0x8000) + data
+    return struct.pack("<H", len(compressed)) + compressed
+
+  inode_table = image.tell()
+  image.write(metadata_block(inode_data))
+  directory_table = image.tell()
+  image.write(metadata_block(directory_data))
+  fragment_metadata = image.tell()
+  image.write(metadata_block(fragment_entries))
+  fragment_table = image.tell()
+  image.write(struct.pack("<Q", fragment_metadata))
+  id_table = image.tell()
+  image.write(struct.pack("<Q", id_table + 8) + metadata_block(b"\0" * 4))
+  bytes_used = image.tell()
+  image.seek(0)
+  image.write(struct.pack("<4sIIIIHHHHHHQQQQQQQQ", b"hsqs", len(inodes), 0, BLOCK_SIZE, 1 if fragment_entries else 0,
+                          compression_id, 12, 0, 1, 4, 0, inode_offsets[root], bytes_used, id_table, 0xFFFFFFFFFFFFFFFF,
+                          inode_table, directory_table, fragment_table, 0xFFFFFFFFFFFFFFFF))
+  return image.getvalue()
+
+def build_sif(squashfs):
+  descriptor_size = struct.calcsize(installer.SIF_DESCRIPTOR_FORMAT)
+  definition = b"Bootstrap: docker\n"
+  data_offset = 128 + 3 * descriptor_size
+  overlay = b"hsqs" + b"\0" * 92
+  # An overlay partition comes first, the reader has to pick the system partition
+  descriptors = struct.pack(installer.SIF_DESCRIPTOR_FORMAT, 0x4001, 1, 1, 0, 0, data_offset, len(definition), len(definition), 0, 0, 0, 0, b"", b"")
+  descriptors += struct.pack(installer.SIF_DESCRIPTOR_FORMAT, 0x4004, 1, 2, 0, 0, data_offset + len(definition), len(overlay), len(overlay), 0, 0, 0, 0, b"",
+                             struct.pack("<ii3s", installer.SIF_FS_SQUASH, 3, b"01"))
+  descriptors += struct.pack(installer.SIF_DESCRIPTOR_FORMAT, 0x4004, 1, 3, 0, 0, data_offset + len(definition) + len(overlay), len(squashfs), len(squashfs), 0, 0, 0, 0, b"",
+                             struct.pack("<ii3s", installer.SIF_FS_SQUASH, installer.SIF_PART_PRIMSYS, b"01"))
+  header = b"#!/usr/bin/env run-singularity\n".ljust(32, b"\0") + b"SIF_MAGIC\0" + b"01\0" + b"01\0" + uuid.uuid4().bytes
+  header += struct.pack("<qqqqqqqq", 0, 0, 0, 3, 128, 3 * descriptor_size, data_offset, len(definition) + len(overlay) + len(squashfs))
+  return header + descriptors + definition + overlay + squashfs
+
+def build_files():
+  random_data = os.urandom(BLOCK_SIZE)
+  return {
+    "parabricks/release-v2.5.0.tar.gz": b"".join(struct.pack("<I", i) for i in range(3000)),
+    "parabricks/README": b"small file that only lives in the fragment block\n",
+    "parabricks/random.bin": random_data + b"tail",
+    "opt/aligned.bin": b"a" * (2 * BLOCK_SIZE),
+    "empty": b"",
+  }
+
+class SquashfsReaderTest(unittest.TestCase):
+  def check_files(self, image_data, offset, files):
+    squashfs = installer.SquashfsImage(io.BytesIO(image_data), offset)
+    for path, data in files.items():
+      self.assertEqual(b"".join(squashfs.iter_file(path)), data, path)
+
+  def test_gzip_basic_inodes(self):
+    files = build_files()
+    self.check_files(build_squashfs(files, 1, gzip_compress, False), 0, files)
+
+  def test_gzip_extended_inodes(self):
+    files = build_files()
+    self.check_files(build_squashfs(files, 1, gzip_compress, True), 0, files)
+
+  @unittest.skipIf(lzma == None, "lzma module not available")
+  def test_xz(self):
+    files = build_files()
+    self.check_files(build_squashfs(files, 4, xz_compress, True), 0, files)
+
+  def test_sif_with_extended_inodes(self):
+    files = build_files()
+    squashfs = build_squashfs(files, 1, gzip_compress, True)
+    sif = build_sif(squashfs)
+    image_file = io.BytesIO(sif)
+    offset = installer.find_squashfs_offset(image_file)
+    self.assertEqual(sif[offset:], squashfs)
+    self.check_files(sif, offset, files)
+
+  def test_simg(self):
+    files = build_files()
+    simg = b"#!/usr/bin/env run-singularity\n" + build_squashfs(files, 1, gzip_compress, False)
+    offset = installer.find_squashfs_offset(io.BytesIO(simg))
+    self.assertEqual(offset, len(b"#!/usr/bin/env run-singularity\n"))
+    self.check_files(simg, offset, files)
+
+  def test_missing_file(self):
+    squashfs = installer.SquashfsImage(io.BytesIO(build_squashfs(build_files(), 1, gzip_compress, False)), 0)
+    with self.assertRaises(installer.ImageFormatError):
+      list(squashfs.iter_file("parabricks/release-v9.9.9.tar.gz"))
+    with self.assertRaises(installer.ImageFormatError):
+      list(squashfs.iter_file("parabricks"))
+
+  def test_not_squashfs(self):
+    with self.assertRaises(installer.ImageFormatError):
+      installer.SquashfsImage(io.BytesIO(b"\0" * 128), 0)
+    with self.assertRaises(installer.ImageFormatError):
+      installer.find_squashfs_offset(io.BytesIO(b"#!/bin/sh\n" + b"\0" * 1000))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import installer
+
+def write_folder(folder, version):
+  os.mkdir(folder)
+  with open(folder + "/version", "w") as version_file:
+    version_file.write(version)
+
+def read_version(folder):
+  with open(folder + "/version") as version_file:
+    return version_file.read()
+
+class UpgradeSwapTest(unittest.TestCase):
+  def setUp(self):
+    self.install_root = tempfile.mkdtemp()
+    self.install_folder = self.install_root + "/parabricks"
+    self.build_folder = self.install_root + "/.parabricks-upgrade-test"
+    write_folder(self.install_folder, "v2.5.0")
+    write_folder(self.build_folder, "v2.6.0")
+    installer.log_file = open(os.devnull, "w")
+    self.ctypes = installer.ctypes
+
+  def tearDown(self):
+    installer.ctypes = self.ctypes
+    installer.log_file.close()
+    shutil.rmtree(self.install_root)
+
+  def test_swap(self):
+    installer.swap_upgrade_folder(self.build_folder, self.install_folder)
+    self.assertEqual(read_version(self.install_folder), "v2.6.0")
+    self.assertEqual(os.listdir(self.install_root), ["parabricks"])
+
+  def test_swap_with_renames(self):
+    installer.ctypes = None
+    installer.swap_upgrade_folder(self.build_folder, self.install_folder)
+    self.assertEqual(read_version(self.install_folder), "v2.6.0")
+    self.assertEqual(os.listdir(self.install_root), ["parabricks"])
+
+  @unittest.skipIf(installer.ctypes == None or not sys.platform.startswith("linux"), "renameat2 is Linux only")
+  def test_exchange(self):
+    if installer.exchange_folders(self.build_folder, self.install_folder) == False:
+      self.skipTest("renameat2(RENAME_EXCHANGE) not supported here")
+    self.assertEqual(read_version(self.install_folder), "v2.6.0")
+    self.assertEqual(read_version(self.build_folder), "v2.5.0")
+
+  def test_recover_interrupted_swap(self):
+    # The installer died between the two renames
+    os.rename(self.install_folder, self.build_folder + ".old")
+    installer.recover_upgrade_folder(self.install_root)
+    self.assertEqual(read_version(self.install_folder), "v2.5.0")
+    self.assertEqual(sorted(os.listdir(self.install_root)), [".parabricks-upgrade-test", "parabricks"])
+
+  def test_remove_retired_folder(self):
+    # The installer died after the swap, before removing the old installation
+    os.rename(self.build_folder, self.build_folder + ".old")
+    installer.recover_upgrade_folder(self.install_root)
+    self.assertEqual(read_version(self.install_folder), "v2.5.0")
+    self.assertEqual(os.listdir(self.install_root), ["parabricks"])
+
+if __name__ == '__main__':
+  unittest.main()